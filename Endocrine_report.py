@@ -1,8 +1,20 @@
 import streamlit as st
+import streamlit.logger
 import re
 import io
+import os
+import threading
+import tracemalloc
+import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 from datetime import date
+from itertools import islice
+from multiprocessing import get_context
+
+# 平行解析的子行程會以 __mp_main__ 重新執行本程式（bare mode），不需要警告訊息
+if __name__ == "__mp_main__":
+    streamlit.logger.set_log_level("error")
 
 # 從文字中擷取第一個 YYYYMMDD（19xx／20xx，月份 01–12、日 01–31）
 _DATE_YYYYMMDD_RE = re.compile(
@@ -34,6 +46,212 @@ def clean_val(v):
     v = re.sub(r"([\d.]+)\s*[LH]$", r"\1", v)
     return v
 
+# 只處理72-300以上的代碼
+def is_report_code(code):
+    return code.startswith('72-') and code[3:].isdigit() and int(code[3:]) >= 300
+
+# LIS 匯出表頭：日期時間列到此結束，下一行開始為檢驗項目
+LIS_HEADER_MARKER = '\t單位\t參考值'
+# 判斷格式時只讀取前幾行
+SNIFF_MAX_LINES = 8
+# 多份資料合計超過此行數才用多行程平行解析，資料少時傳送資料的成本比解析還高
+PARALLEL_MIN_LINES = 5000
+# 頁面平行解析的行程數，由環境變數 ENDOCRINE_PARSE_WORKERS 設定，預設為 CPU 數（最多 4）；1 表示不平行
+PARSE_WORKERS = int(os.environ.get("ENDOCRINE_PARSE_WORKERS", "0")) or min(os.cpu_count() or 1, 4)
+# 記憶體預算（MB），由環境變數 ENDOCRINE_MEMORY_BUDGET_MB 設定，0 表示不限制
+MEMORY_BUDGET_MB = float(os.environ.get("ENDOCRINE_MEMORY_BUDGET_MB", "0"))
+# 頁面是否量測並顯示記憶體峰值，由環境變數 ENDOCRINE_MEASURE_MEMORY=1 開啟；tracemalloc 會讓轉換慢數倍，預設關閉
+MEASURE_MEMORY = os.environ.get("ENDOCRINE_MEASURE_MEMORY", "") == "1"
+# 實測解析加產生報告的記憶體峰值約為輸入字元數的 30~40 倍，用來預估是否超出預算
+PEAK_MEMORY_PER_INPUT_CHAR = 40
+
+# LIS 匯出格式註冊表：格式名稱 -> (判斷函式, 解析函式)
+LIS_DIALECTS = {}
+
+def register_lis_dialect(name, sniff):
+    """註冊 LIS 匯出格式，sniff 只看前幾行判斷是否為此格式，parse(lines, keep_code) 回傳 export"""
+    def decorator(parse):
+        LIS_DIALECTS[name] = (sniff, parse)
+        return parse
+    return decorator
+
+def split_lab_lines(text):
+    """去除空白行與前後空白"""
+    return [line.strip() for line in text.splitlines() if line.strip()]
+
+def sniff_lis_dialect(lines, max_lines=SNIFF_MAX_LINES):
+    """只讀前幾行判斷 LIS 匯出格式，無法辨識時回傳 None"""
+    head = lines[:max_lines]
+    for name, (sniff, _) in LIS_DIALECTS.items():
+        if sniff(head):
+            return name
+    return None
+
+# 與 str.splitlines() 相同的換行字元，逐行讀取與整份切開的結果才會一致
+_LINE_RE = re.compile(r"[^\n\r\x0b\x0c\x1c-\x1e\x85\u2028\u2029]+")
+
+def iter_lab_lines(text):
+    """逐行產生去除前後空白的非空白行（同 split_lab_lines），只讀到需要的位置"""
+    for m in _LINE_RE.finditer(text):
+        line = m.group(0).strip()
+        if line:
+            yield line
+
+def sniff_lis_text(text, max_lines=SNIFF_MAX_LINES):
+    """只讀取貼上內容開頭的幾個非空白行判斷格式，不切開整份資料"""
+    return sniff_lis_dialect(list(islice(iter_lab_lines(text), max_lines)), max_lines)
+
+def parse_lis_export(lines, keep_code=None):
+    """依格式交給對應的解析函式，回傳 {"dialect", "dt_pairs", "rows", "first_date"}，非 LIS 資料回傳 None
+
+    rows 每一筆為 (code, name, specimen, values, unit, ref)，values 與 dt_pairs 一一對應；
+    keep_code 用於低記憶體模式，只保留 keep_code(code) 為真的項目
+    """
+    dialect = sniff_lis_dialect(lines)
+    if dialect is None:
+        return None
+    export = LIS_DIALECTS[dialect][1](lines, keep_code)
+    export["dialect"] = dialect
+    # 資料中第一個日期，找不到測試日期時使用
+    export["first_date"] = next((d for d in map(first_yyyymmdd_in_text, lines) if d), None)
+    return export
+
+def parse_lis_text(text):
+    return parse_lis_export(split_lab_lines(text))
+
+def split_lis_exports(lines):
+    """多份 LIS 匯出前後接在一起時，在每份的開頭切開（單次掃描），回傳各份的行列表"""
+    segments = []
+    start = 0
+    in_rows = False
+    for idx, line in enumerate(lines):
+        if not in_rows:
+            in_rows = LIS_HEADER_MARKER in line
+        # 檢驗項目列之後又出現最後一欄為日期的行，且前幾行可辨識為 LIS 格式，即為下一份的開頭
+        elif (not line.startswith('True\t') and _DATE_YYYYMMDD_RE.fullmatch(line.rsplit('\t', 1)[-1])
+                and sniff_lis_dialect(lines[idx:idx+SNIFF_MAX_LINES]) is not None):
+            segments.append(lines[start:idx])
+            start = idx
+            in_rows = False
+    segments.append(lines[start:])
+    return segments
+
+@st.cache_resource
+def get_parse_pool():
+    """所有 session 共用、常駐的解析行程池
+
+    Streamlit 伺服器是多執行緒行程，直接 fork 不安全，因此以 forkserver 建立子行程；
+    子行程在第一次使用時才啟動
+    """
+    return ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=get_context("forkserver"))
+
+def parse_exports(text, keep_code=None, pool=None):
+    """分段後各自解析，回傳每一份的 export（無法辨識為 None）
+
+    有 pool、多份且資料量大時各份交給不同行程平行解析；指定 keep_code（低記憶體模式）時依序解析，
+    避免各行程各自複製一份資料
+    """
+    segments = split_lis_exports(split_lab_lines(text))
+    if (pool is not None and keep_code is None and len(segments) > 1
+            and sum(len(segment) for segment in segments) >= PARALLEL_MIN_LINES):
+        return list(pool.map(parse_lis_export, segments))
+    return [parse_lis_export(segment, keep_code) for segment in segments]
+
+def predict_peak_memory(text):
+    """依輸入大小預估轉換的記憶體峰值（bytes）"""
+    return len(text) * PEAK_MEMORY_PER_INPUT_CHAR
+
+def use_low_memory(text, budget_mb=None):
+    """預估會超出記憶體預算時改用低記憶體模式"""
+    budget_mb = MEMORY_BUDGET_MB if budget_mb is None else budget_mb
+    return budget_mb > 0 and predict_peak_memory(text) > budget_mb * 1024 * 1024
+
+_TRACEMALLOC_LOCK = threading.Lock()
+
+def measure_peak_memory(func, *args, **kwargs):
+    """以 tracemalloc 量測 func 執行期間新增的記憶體峰值，回傳 (結果, 峰值 bytes)
+
+    tracemalloc 追蹤整個行程，同一時間只量測一個轉換；已有其他量測進行中時不等待，
+    直接執行 func 並回傳峰值 None。同時有其他執行緒在轉換時，峰值會包含它們的配置
+    """
+    if not _TRACEMALLOC_LOCK.acquire(blocking=False):
+        return func(*args, **kwargs), None
+    try:
+        was_tracing = tracemalloc.is_tracing()
+        if not was_tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        try:
+            result = func(*args, **kwargs)
+            peak = tracemalloc.get_traced_memory()[1] - baseline
+        finally:
+            if not was_tracing:
+                tracemalloc.stop()
+    finally:
+        _TRACEMALLOC_LOCK.release()
+    return result, peak
+
+def maybe_measure_peak_memory(func, *args, **kwargs):
+    """頁面用：有開啟 MEASURE_MEMORY 才量測，否則直接執行並回傳峰值 None"""
+    if not MEASURE_MEMORY:
+        return func(*args, **kwargs), None
+    return measure_peak_memory(func, *args, **kwargs)
+
+# 新版檢驗報告：第一行最後一欄為日期，之後每行為「上一欄時間\t日期」，直到單位/參考值表頭
+def _sniff_new_report(head):
+    if len(head) < 2:
+        return False
+    first = head[0].split('\t')
+    if len(first) < 2 or not _DATE_YYYYMMDD_RE.fullmatch(first[-1]):
+        return False
+    for line in head[1:]:
+        if LIS_HEADER_MARKER in line:
+            return True
+        parts = line.split('\t')
+        if len(parts) < 2 or not _DATE_YYYYMMDD_RE.fullmatch(parts[-1]):
+            return False
+    # 時間點多於 SNIFF_MAX_LINES，表頭在更後面
+    return True
+
+@register_lis_dialect("new_report", _sniff_new_report)
+def parse_new_report(lines, keep_code=None):
+    # 取得日期時間對應表
+    date_lines = []
+    start = len(lines)
+    for idx, line in enumerate(lines):
+        if LIS_HEADER_MARKER in line:
+            start = idx+1
+            break
+        date_lines.append(line)
+    dt_pairs = []
+    for i in range(len(date_lines)-1):
+        date = date_lines[i].split('\t')[-1]
+        time = date_lines[i+1].split('\t')[0]
+        dt_pairs.append((date, time))
+    # 補最後一個日期與時間
+    if len(date_lines) >= 2:
+        last_date = date_lines[-1].split('\t')[-1]
+        last_time = date_lines[-1].split('\t')[0]
+        dt_pairs.append((last_date, last_time))
+    elif date_lines and LIS_HEADER_MARKER in lines[start-1]:
+        # 只有一個時間點：第一行的第一欄是表頭（選取），時間在單位/參考值表頭行的第一欄
+        dt_pairs.append((date_lines[0].split('\t')[-1], lines[start-1].split('\t')[0]))
+    rows = []
+    for line in lines[start:]:
+        # 低記憶體模式：先只切出代碼，不需要的項目不切開整行
+        if keep_code is not None:
+            head = line.split('\t', 2)
+            if len(head) < 3 or not keep_code(head[1]):
+                continue
+        parts = line.split('\t')
+        if len(parts) < 6 or parts[0] != 'True':
+            continue
+        # 數值欄位在檢體之後、單位與參考值之前
+        values = [clean_val(v.strip()) if v.strip() else "" for v in parts[4:-2]]
+        rows.append((parts[1], parts[2], parts[3], values, parts[-2], parts[-1]))
+    return {"dt_pairs": dt_pairs, "rows": rows}
+
 # 計算字串寬度（中文字佔2字元，其他佔1字元）
 def get_string_width(s):
     """計算字串的顯示寬度，中文字佔2字元，其他佔1字元"""
@@ -153,82 +371,207 @@ def get_glucagon_separator(items, width=11):
     separator_length = max(total_chars // 2, 10)  # 最少10個字元
     return "＝" * separator_length
 
+# 單位系統：傳統單位（病歷預設）或 SI 單位
+UNIT_SYSTEMS = {"conventional": "傳統單位", "SI": "SI 單位"}
+
+# SI 單位換算：項目名稱 -> (傳統單位, SI 單位, 換算倍數, 小數位數)；倍數為 1 時數值不變，只更換單位名稱
+SI_CONVERSIONS = {
+    "BS": ("mg/dL", "mmol/L", 0.0555, 1),
+    "Blood Sugar": ("mg/dL", "mmol/L", 0.0555, 1),
+    "Cortisol": ("ug/dL", "nmol/L", 27.59, 0),
+    "GH": ("ng/mL", "ug/L", 1, None),
+    "TSH": ("uIU/mL", "mIU/L", 1, None),
+    "PRL": ("ng/mL", "ug/L", 1, None),
+    "LH": ("mIU/mL", "IU/L", 1, None),
+    "FSH": ("mIU/mL", "IU/L", 1, None),
+    "Testosterone": ("ng/mL", "nmol/L", 3.467, 2),
+    "E2": ("pg/mL", "pmol/L", 3.671, 0),
+    "ACTH": ("pg/mL", "pmol/L", 0.2202, 1),
+    "C-peptide": ("ng/mL", "nmol/L", 0.331, 2),
+}
+# 同日檢驗表格依代碼找換算項目
+SI_CODE_NAMES = dict(zip(PRIMARY_CODES + OPTIONAL_CODES, PRIMARY_NAMES + OPTIONAL_NAMES), **{"72-497": "C-peptide"})
+
+def get_unit(name, unit, unit_system="conventional"):
+    """依單位系統回傳項目的單位"""
+    if unit_system == "SI" and name in SI_CONVERSIONS:
+        return SI_CONVERSIONS[name][1]
+    return unit
+
+def _si_decimals(converted, decimals):
+    """換算後的小數位數：預設為項目的小數位數，非零的值會被捨入成 0 時改取 2 位有效數字"""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        significant = 1 - np.floor(np.log10(converted))
+        too_small = (converted > 0) & (converted < 0.5 * 10.0 ** -decimals)
+    return np.where(too_small, np.maximum(decimals, significant), decimals)
+
+def convert_values_to_si(values, names):
+    """把檢驗值換算成 SI 單位，names[i] 為 values[i] 的項目名稱（None 表示不換算）
+
+    所有值一次以向量運算換算；<、> 設限值保留符號，"--" 等非數值與倍數為 1 的項目維持原字串
+    """
+    if not values:
+        return []
+    spec = [SI_CONVERSIONS.get(n, (None, None, 1, None)) for n in names]
+    factors = np.array([s[2] for s in spec], dtype=float)
+    decimals = np.array([0 if s[3] is None else s[3] for s in spec], dtype=float)
+    values = pd.Series(values, dtype=object)
+    parts = values.str.extract(r"^([<>]?)\s*(\d+(?:\.\d+)?)$")
+    converted = parts[1].astype(float).to_numpy() * factors
+    mask = parts[1].notna().to_numpy() & (factors != 1)
+    decimals = _si_decimals(converted, decimals)
+    out = values.copy()
+    for d in np.unique(decimals[mask]):
+        sub = mask & (decimals == d)
+        out[sub] = parts[0][sub] + pd.Series(converted[sub], index=out.index[sub]).map(f"{{:.{int(d)}f}}".format)
+    return out.tolist()
+
+def convert_table_to_si(table_rows, col_names):
+    """主表格（第一欄為時間）所有數值一次換算成 SI 單位"""
+    flat = [v for row in table_rows for v in row[1:]]
+    converted = convert_values_to_si(flat, [n for _ in table_rows for n in col_names])
+    width = len(col_names)
+    return [[row[0]] + converted[i*width:(i+1)*width] for i, row in enumerate(table_rows)]
+
+# 可換算的參考值：單一範圍（2.8-8.0）或單邊界（<5、>=10），其他含年齡、性別等註記的參考值不換算
+_SIMPLE_REF_RE = re.compile(r"^\s*([<>≦≧＜＞]=?)?\s*(\d+(?:\.\d+)?)\s*(?:([-~])\s*(\d+(?:\.\d+)?))?\s*$")
+
+def convert_ref_to_si(ref, name):
+    """參考值換算成 SI 單位；無法安全換算的參考值維持原樣並標示原單位"""
+    unit, _, factor, decimals = SI_CONVERSIONS[name]
+    if factor == 1:
+        return ref
+    m = _SIMPLE_REF_RE.match(ref)
+    if not m:
+        return f"{ref} ({unit})" if ref.strip() else ref
+    bounds = np.array([float(b) for b in m.group(2, 4) if b is not None]) * factor
+    places = _si_decimals(bounds, np.full(len(bounds), float(decimals)))
+    low, *high = [f"{b:.{int(d)}f}" for b, d in zip(bounds, places)]
+    return (m.group(1) or "") + low + (f"{m.group(3)}{high[0]}" if high else "")
+
+def index_values_by_date(export):
+    """所有項目依日期整理有值的 index：code -> {date: [index, ...]}
+
+    單次掃描後存在 export 中，各檢查找測試日期、切換日期時都直接查表
+    """
+    if "by_date" not in export:
+        dt_pairs = export["dt_pairs"]
+        by_date = {}
+        for code, _, _, values, _, _ in export["rows"]:
+            # 同一個 code 出現多次時以最後一列為準
+            by_date[code] = code_dates = {}
+            for i, v in enumerate(values):
+                if v and i < len(dt_pairs):
+                    code_dates.setdefault(dt_pairs[i][0], []).append(i)
+        export["by_date"] = by_date
+    return export["by_date"]
+
+def index_same_day_rows(export):
+    """同日檢驗表格用：所有有值的血液檢驗依日期整理 date -> [(code, name, value, unit, ref), ...]（依代碼排序）
+
+    單次掃描後存在 export 中，切換日期只需查表與排版
+    """
+    if "same_day_rows" not in export:
+        dt_pairs = export["dt_pairs"]
+        last = len(dt_pairs) - 1
+        same_day_rows = {}
+        for code, name, specimen, values, unit, ref in export["rows"]:
+            if specimen != 'B' or not is_report_code(code):
+                continue
+            for idx, v in enumerate(values):
+                if not v:
+                    continue
+                # 數值欄位多於日期時，沿用最後一個日期
+                dt = dt_pairs[min(idx, last)][0] if dt_pairs else ''
+                same_day_rows.setdefault(dt, []).append((code, name, v, unit, ref))
+        for rows in same_day_rows.values():
+            rows.sort(key=lambda x: x[0])
+        export["same_day_rows"] = same_day_rows
+    return export["same_day_rows"]
+
+def get_lab_dates(export):
+    """有血液檢驗的日期，由新到舊"""
+    return sorted((d for d in index_same_day_rows(export) if d), reverse=True)
+
+def _count_on(by_date, code, d):
+    return len(by_date.get(code, {}).get(d, []))
+
+# 以下各檢查的 find_*_sessions 回傳所有符合條件的測試日期與完整度 [(date, score), ...]，由新到舊排序
+# 完整度為該檢查應有的時間點中有值的比例
+
+def find_insulin_sessions(export):
+    # BS 與 Cortisol 同一天各有 7 筆以上
+    by_date = index_values_by_date(export)
+    sessions = []
+    for d in set(by_date.get(PRIMARY_CODES[0], {})):
+        if not all(_count_on(by_date, code, d) >= 7 for code in PRIMARY_CODES):
+            continue
+        # 主表格會顯示的項目：主項目與同一天有兩筆以上的 optional 項目
+        shown = [code for code in PRIMARY_CODES + OPTIONAL_CODES if _count_on(by_date, code, d) >= 2]
+        score = sum(min(_count_on(by_date, code, d), 7) for code in shown) / (7 * len(shown))
+        sessions.append((d, score))
+    return sorted(sessions, reverse=True)
+
+def find_clonidine_sessions(export):
+    # GH 同一天有 5 筆以上，且當天沒有 cortisol
+    by_date = index_values_by_date(export)
+    sessions = []
+    for d, indices in by_date.get("72-476", {}).items():
+        if len(indices) >= 5 and not _count_on(by_date, "72-488", d):
+            sessions.append((d, min(len(indices), 5) / 5))
+    return sorted(sessions, reverse=True)
+
+def find_gnrh_sessions(export):
+    # LH 或 FSH 同一天有兩筆以上
+    by_date = index_values_by_date(export)
+    sessions = []
+    for d in set(by_date.get("72-482", {})) | set(by_date.get("72-483", {})):
+        counts = [min(_count_on(by_date, code, d), 5) for code in ("72-482", "72-483")]
+        if max(counts) >= 2:
+            sessions.append((d, sum(counts) / 10))
+    return sorted(sessions, reverse=True)
+
+def find_glucagon_sessions(export):
+    # 當天要有 C-peptide，且血糖或 C-peptide 有 4 筆以上；只有血糖的日子（如 Insulin test）不算
+    by_date = index_values_by_date(export)
+    sessions = []
+    for d in by_date.get("72-497", {}):
+        counts = [min(_count_on(by_date, code, d), 4) for code in ("72-314", "72-497")]
+        if max(counts) >= 4:
+            sessions.append((d, sum(counts) / 8))
+    return sorted(sessions, reverse=True)
+
 # 解析檢驗項目，並找出所有目標項目同時有值的七個index（不要求連續）
-def parse_items_common_seven_anywhere(lines):
+# target_date 未指定時取最新一次測試
+def parse_items_common_seven_anywhere(export, target_date=None):
     single_value_optional_codes = set()
     main_table_codes = set(PRIMARY_CODES)
-    start = 0
-    for idx, line in enumerate(lines):
-        if '\t單位\t參考值' in line:
-            start = idx+1
-            break
-    # 取得日期時間對應表
-    date_lines = []
-    for line in lines:
-        if '\t單位\t參考值' in line:
-            break
-        date_lines.append(line)
-    dt_pairs = []
-    for i in range(len(date_lines)-1):
-        date = date_lines[i].split('\t')[-1]
-        time = date_lines[i+1].split('\t')[0]
-        dt_pairs.append((date, time))
-    # 新增：補最後一個日期與時間
-    if len(date_lines) >= 2:
-        last_date = date_lines[-1].split('\t')[-1]
-        last_time = date_lines[-1].split('\t')[0]
-        dt_pairs.append((last_date, last_time))
+    dt_pairs = export["dt_pairs"]
     all_items = {}
     code_values = {}
-    for line in lines[start:]:
-        parts = line.split('\t')
-        if len(parts) < 5 or parts[0] != 'True':
-            continue
-        code = parts[1]
-        name = parts[2]
-        # 只處理72-300以上的代碼
-        if not (code.startswith('72-') and code[3:].isdigit() and int(code[3:]) >= 300):
+    for code, name, _, values, _, _ in export["rows"]:
+        if not is_report_code(code):
             continue
-        values = [clean_val(v.strip()) if v.strip() else "" for v in parts[4:-2]]
         all_items[name] = values
         code_values[code] = values
-    # 依據 dt_pairs 對應每一個數值的日期
-    # 找出主項目各自有7筆的日期
-    date_indices = {code: {} for code in PRIMARY_CODES}
-    for code in PRIMARY_CODES:
-        v = code_values.get(code, [])
-        for i, val in enumerate(v):
-            if val and i < len(dt_pairs):
-                d = dt_pairs[i][0]
-                date_indices[code].setdefault(d, []).append(i)
-    # 找出同時有7個值的日期
-    candidate_dates = []
-    for d in set.intersection(*(set(date_indices[code].keys()) for code in PRIMARY_CODES)):
-        if all(len(date_indices[code][d]) >= 7 for code in PRIMARY_CODES):
-            candidate_dates.append(d)
-    if not candidate_dates:
+    candidate_dates = [d for d, _ in find_insulin_sessions(export)]
+    if target_date is None and candidate_dates:
+        target_date = candidate_dates[0]
+    if target_date not in candidate_dates:
         return {}, all_items, dt_pairs, [], set(), set()
-    # 取最新的日期
-    target_date = sorted(candidate_dates)[-1]
+    by_date = index_values_by_date(export)
     items = {}
     # 主項目（BS、GH、Cortisol）各自依index由大到小排序，取7個值
-    bs_indices = sorted(date_indices[PRIMARY_CODES[0]][target_date], reverse=True)
+    bs_indices = sorted(by_date[PRIMARY_CODES[0]][target_date], reverse=True)
     for code, tname in zip(PRIMARY_CODES, PRIMARY_NAMES):
-        indices = sorted(date_indices[code][target_date], reverse=True)
+        indices = sorted(by_date[code][target_date], reverse=True)
         v = code_values.get(code, [])
         items[tname] = [v[i] for i in indices]
     # optional code 收集同一天日期下有值的 index，忽略空值
     for code, tname in zip(OPTIONAL_CODES, OPTIONAL_NAMES):
         v = code_values.get(code, [])
-        # 找出該 code 在同一天日期下有值的 index
-        code_indices = []
-        for i, val in enumerate(v):
-            if val and i < len(dt_pairs):
-                d = dt_pairs[i][0]
-                if d == target_date:
-                    code_indices.append(i)
-        # 依 index 由大到小排序
-        code_indices = sorted(code_indices, reverse=True)
+        # 該 code 在同一天日期下有值的 index，依 index 由大到小排序
+        code_indices = sorted(by_date.get(code, {}).get(target_date, []), reverse=True)
         # 取值
         vals = [v[i] for i in code_indices]
         # 特殊處理：testosterone 和 E2 如果有兩個值，一定要佔第一和第七位置
@@ -246,54 +589,23 @@ def parse_items_common_seven_anywhere(lines):
             items[tname] = vals
     return items, all_items, dt_pairs, bs_indices, single_value_optional_codes, main_table_codes
 
-def get_same_day_lab_table(lines, target_date, exclude_codes=None):
-    # 取得所有檢驗項目（同一天）
-    start = 0
-    for idx, line in enumerate(lines):
-        if '\t單位\t參考值' in line:
-            start = idx+1
-            break
-    # 產生 date_lines，對應數值欄位的日期
-    date_lines = []
-    for line in lines:
-        if '\t單位\t參考值' in line:
-            break
-        date_lines.append(line)
-    lab_rows = []
-    for line in lines[start:]:
-        parts = line.split('\t')
-        if len(parts) < 6 or parts[0] != 'True':
-            continue
-        if parts[3] != 'B':
-            continue
-        code = parts[1]
-        # 只處理72-300以上的代碼
-        if not (code.startswith('72-') and code[3:].isdigit() and int(code[3:]) >= 300):
-            continue
-        name = parts[2]
-        unit = parts[-2]
-        ref = parts[-1]
-        values = [clean_val(v.strip()) if v.strip() else "" for v in parts[4:-2]]  # 只抓數值欄位
-        # 補齊 date_lines 長度
-        while len(date_lines) < len(values):
-            date_lines.append(date_lines[-1])
-        for idx, v in enumerate(values):
-            v = v.strip()
-            if not v:
-                continue
-            dt = ''
-            if idx < len(date_lines):
-                dt = date_lines[idx].split('\t')[-1]
-            if dt == target_date:
-                # 移除數值結尾的 L 或 H
-                v_clean = clean_val(v)
-                lab_rows.append((code, name, v_clean, unit, ref))
+def get_same_day_lab_table(export, target_date, exclude_codes=None, unit_system="conventional"):
+    # 取得所有檢驗項目（同一天），已依代碼排序
+    lab_rows = index_same_day_rows(export).get(target_date, [])
     # 排除主表格已出現的項目（primary+optional codes）
     if exclude_codes is not None:
         all_exclude = set(exclude_codes)
         all_exclude.add("72-48A")  # 額外排除 72-48A
         lab_rows = [row for row in lab_rows if row[0] not in all_exclude]
-    lab_rows.sort(key=lambda x: x[0])
+    # SI 單位：只換算單位與傳統單位相符的項目，數值一次換算
+    if unit_system == "SI" and lab_rows:
+        names = []
+        for code, _, _, unit, _ in lab_rows:
+            name = SI_CODE_NAMES.get(code)
+            names.append(name if name in SI_CONVERSIONS and unit.lower() == SI_CONVERSIONS[name][0].lower() else None)
+        values = convert_values_to_si([row[2] for row in lab_rows], names)
+        lab_rows = [(code, lab_name, v, get_unit(n, unit, "SI") if n else unit, convert_ref_to_si(ref, n) if n else ref)
+                    for (code, lab_name, _, unit, ref), v, n in zip(lab_rows, values, names)]
     output = io.StringIO()
     # 下方表格（get_same_day_lab_table）
     header_row = ["檢驗項目", "檢驗值", "單位", "參考值"]
@@ -316,10 +628,24 @@ def get_same_day_lab_table(lines, target_date, exclude_codes=None):
     print(separator, file=output)
     return output.getvalue() if lab_rows else "\n"
 
+def render_same_day_panels(export, unit_system="conventional"):
+    """所有日期的同日檢驗表格（由新到舊），批次輸出用"""
+    output = io.StringIO()
+    for d in get_lab_dates(export):
+        print(f"＝ {d[:4]}/{d[4:6]}/{d[6:]} ＝", file=output)
+        print(get_same_day_lab_table(export, d, unit_system=unit_system), file=output)
+    return output.getvalue()
+
 # 修改 convert_lab_text_common_seven_anywhere 支援 time_labels 參數
-def convert_lab_text_common_seven_anywhere(text, time_labels=None, glucagon_title=False):
-    lines = [line.strip() for line in text.splitlines() if line.strip()]
-    items, all_items, dt_pairs, seven_indices, single_value_optional_codes, main_table_codes = parse_items_common_seven_anywhere(lines)
+def convert_lab_text_common_seven_anywhere(text, time_labels=None, glucagon_title=False, target_date=None, unit_system="conventional"):
+    export = parse_lis_text(text)
+    if export is None:
+        return None
+    return render_common_seven_report(export, time_labels=time_labels, glucagon_title=glucagon_title, target_date=target_date, unit_system=unit_system)
+
+# full_matrix=False 時不建立完整表格（所有檢驗項目 x 所有時間點），full_df 回傳 None
+def render_common_seven_report(export, time_labels=None, glucagon_title=False, target_date=None, full_matrix=True, unit_system="conventional"):
+    items, all_items, dt_pairs, seven_indices, single_value_optional_codes, main_table_codes = parse_items_common_seven_anywhere(export, target_date)
     # 日期格式：以七個index中最早的日期為主
     date_fmt = ""
     target_date = ""
@@ -330,7 +656,7 @@ def convert_lab_text_common_seven_anywhere(text, time_labels=None, glucagon_titl
             date_fmt = f"{min_date[:4]}/{min_date[4:6]}/{min_date[6:]}"
             target_date = min_date
     if not date_fmt:
-        date_str = first_yyyymmdd_in_text(" ".join(lines)) or date.today().strftime("%Y%m%d")
+        date_str = export["first_date"] or date.today().strftime("%Y%m%d")
         date_fmt = f"{date_str[:4]}/{date_str[4:6]}/{date_str[6:]}"
         target_date = date_str
     output = io.StringIO()
@@ -344,7 +670,7 @@ def convert_lab_text_common_seven_anywhere(text, time_labels=None, glucagon_titl
     print(format_with_fixed_width([""] + col_names), file=output)
     # 單位
     unit_map = {"BS": "mg/dL", "GH": "ng/mL", "Cortisol": "ug/dL", "TSH": "uIU/mL", "PRL": "ng/mL", "LH": "mIU/mL", "FSH": "mIU/mL", "Testosterone": "ng/mL", "E2": "pg/mL"}
-    header_row = ["時間"] + [unit_map.get(n, "") for n in items.keys()]
+    header_row = ["時間"] + [get_unit(n, unit_map.get(n, ""), unit_system) for n in items.keys()]
     print(format_with_fixed_width(header_row), file=output)
     separator = get_dynamic_separator(header_row)
     print(separator, file=output)
@@ -358,15 +684,20 @@ def convert_lab_text_common_seven_anywhere(text, time_labels=None, glucagon_titl
                 row.append(item_data[i])
             else:
                 row.append("--")
-        print(format_with_fixed_width(row), file=output)
         table_rows.append(row)
+    if unit_system == "SI":
+        table_rows = convert_table_to_si(table_rows, col_names)
+    for row in table_rows:
+        print(format_with_fixed_width(row), file=output)
     print(separator, file=output)
     # 產生同日檢驗項目表格（排除主表格項目）
     # 產生同日檢驗項目表格時，exclude_codes 只排除主表格顯示的 code
     exclude_codes = list(main_table_codes)
-    print(get_same_day_lab_table(lines, target_date, exclude_codes=exclude_codes), file=output)
+    print(get_same_day_lab_table(export, target_date, exclude_codes=exclude_codes, unit_system=unit_system), file=output)
     columns = ["時間"] + list(items.keys())
     df = pd.DataFrame.from_records(table_rows, columns=columns)
+    if not full_matrix:
+        return output.getvalue(), df, None
     # 產生唯一欄位名稱
     columns = []
     col_count = {}
@@ -384,447 +715,222 @@ def convert_lab_text_common_seven_anywhere(text, time_labels=None, glucagon_titl
     full_df.index.name = '檢驗項目'
     return output.getvalue(), df, full_df
 
-# 頁面切換（改用 tabs）
-tabs = st.tabs(["Insulin/TRH/GnRH test", "Clonidine test", "GnRH stimulation test", "Glucagon test for C-peptide function"])
+# target_date 未指定時取最新一次測試
+def parse_clonidine_gh_five(export, target_date=None):
+    # 找出有5項GH數值且沒有cortisol的日期
+    sessions = [d for d, _ in find_clonidine_sessions(export)]
+    if target_date is None and sessions:
+        target_date = sessions[0]
+    gh_values = []
+    if target_date in sessions:
+        gh_data = {code: values for code, _, _, values, _, _ in export["rows"]}["72-476"]  # GH的代碼
+        # 依index排序，從大到小
+        gh_indices = sorted(index_values_by_date(export)["72-476"][target_date], reverse=True)
+        gh_values = [gh_data[i] for i in gh_indices[:5]]
 
-with tabs[0]:
-    st.header("Insulin/TRH/GnRH test")
-    use_glucagon_time = st.checkbox("將insulin改為glucagon")
-    input_text = st.text_area("貼上原始data：", height=300)
-    if st.button("產生病歷格式", key="insulin_btn"):
-        if input_text.strip():
-            time_labels = ["-1'", "30'", "60'", "90'", "120'", "150'", "180'"] if use_glucagon_time else FIXED_TIME_LABELS
-            result, df, full_df = convert_lab_text_common_seven_anywhere(input_text, time_labels=time_labels, glucagon_title=use_glucagon_time)
-            # 判斷主表格是否完全沒有數值
-            df_check = df.replace('--', '').replace('', float('nan')).drop('時間', axis=1)
-            all_empty = df_check.isna().values.all()
-            if all_empty:
-                st.warning("⚠️ 無法擷取任何數值，可能檢驗格式有錯，或是沒有做過此項檢查。")
-            #st.write("完整表格（所有檢驗項目 x 所有時間點）：")
-            #st.dataframe(full_df, use_container_width=True)
-            if not all_empty:
-                st.text_area("病歷：", result, height=300)
-                st.dataframe(df, use_container_width=True)
-                st.download_button("下載文字檔", result, file_name="converted_report.txt")
-        else:
-            st.warning("請先貼上原始data！")
+    # 如果沒找到符合條件的日期，返回None表示錯誤
+    if not gh_values:
+        return None
+    return gh_values, target_date
 
-with tabs[1]:
-    st.header("Clonidine test")
-    input_text = st.text_area("貼上原始data：", key="clonidine_input", height=300)
-    if st.button("產生病歷格式", key="clonidine_btn"):
-        if input_text.strip():
-            def parse_clonidine_gh_five(lines):
-                start = 0
-                for idx, line in enumerate(lines):
-                    if '\t單位\t參考值' in line:
-                        start = idx+1
-                        break
-                
-                # 取得日期時間對應表
-                date_lines = []
-                for line in lines:
-                    if '\t單位\t參考值' in line:
-                        break
-                    date_lines.append(line)
-                dt_pairs = []
-                for i in range(len(date_lines)-1):
-                    date = date_lines[i].split('\t')[-1]
-                    time = date_lines[i+1].split('\t')[0]
-                    dt_pairs.append((date, time))
-                # 補最後一組
-                if len(date_lines) >= 2:
-                    last_date = date_lines[-1].split('\t')[-1]
-                    last_time = date_lines[-1].split('\t')[0]
-                    dt_pairs.append((last_date, last_time))
-                
-                # 收集所有檢驗項目的資料
-                all_data = {}
-                for line in lines[start:]:
-                    parts = line.split('\t')
-                    if len(parts) < 5 or parts[0] != 'True':
-                        continue
-                    code = parts[1]
-                    name = parts[2]
-                    values = [clean_val(v.strip()) if v.strip() else "" for v in parts[4:]]
-                    all_data[code] = values
-                
-                # 找出有5項GH數值且沒有cortisol的日期
-                target_date = None
-                gh_values = []
-                
-                # 檢查每個日期
-                for date in set(dt_pairs[i][0] for i in range(len(dt_pairs))):
-                    # 檢查該日期是否有cortisol
-                    has_cortisol = False
-                    if "72-488" in all_data:  # cortisol的代碼
-                        cortisol_values = all_data["72-488"]
-                        for i, val in enumerate(cortisol_values):
-                            if val and i < len(dt_pairs) and dt_pairs[i][0] == date:
-                                has_cortisol = True
-                                break
-                    
-                    if has_cortisol:
-                        continue  # 跳過有cortisol的日期
-                    
-                    # 檢查該日期的GH數值
-                    if "72-476" in all_data:  # GH的代碼
-                        gh_data = all_data["72-476"]
-                        date_gh_values = []
-                        for i, val in enumerate(gh_data):
-                            if val and i < len(dt_pairs) and dt_pairs[i][0] == date:
-                                date_gh_values.append((i, val))
-                        
-                        if len(date_gh_values) >= 5:
-                            # 找到符合條件的日期
-                            target_date = date
-                            # 依index排序，從大到小
-                            date_gh_values.sort(key=lambda x: x[0], reverse=True)
-                            gh_values = [v for _, v in date_gh_values[:5]]
-                            break
-                
-                # 如果沒找到符合條件的日期，返回None表示錯誤
-                if not gh_values:
-                    return None, None
-                return gh_values, target_date
-            def convert_clonidine_lab_text(text):
-                lines = [line.strip() for line in text.splitlines() if line.strip()]
-                result = parse_clonidine_gh_five(lines)
-                
-                # 檢查是否找到符合條件的資料
-                if result is None:
-                    return None, None
-                
-                gh_values, target_date = result
-                
-                # 格式化日期
-                if target_date:
-                    # 假設日期格式為 YYYYMMDD
-                    if len(target_date) == 8:
-                        date_fmt = f"{target_date[:4]}/{target_date[4:6]}/{target_date[6:]}"
-                    else:
-                        date_fmt = target_date
-                else:
-                    date_fmt = "未知日期"
-                time_labels = ["0'", "30'", "60'", "90'", "120'"]
-                output = io.StringIO()
-                print(f"＝ Clonidine test on {date_fmt} ＝\n", file=output)
-                print(format_with_fixed_width(["", "GH"]), file=output)
-                header_row = ["時間", "ng/mL"]
-                print(format_with_fixed_width(header_row), file=output)
-                separator = get_dynamic_separator(header_row)
-                print(separator, file=output)
-                table_rows = []
-                for i, label in enumerate(time_labels):
-                    row = [label, gh_values[i] if i < len(gh_values) else "--"]
-                    print(format_with_fixed_width(row), file=output)
-                    table_rows.append(row)
-                print(separator, file=output)
-                df = pd.DataFrame.from_records(table_rows, columns=["時間", "GH"])
-                return output.getvalue(), df, target_date
-            result, df, target_date = convert_clonidine_lab_text(input_text)
-            
-            # 檢查是否找到符合條件的資料
-            if result is None:
-                st.warning("⚠️ 無法擷取任何數值，可能檢驗格式有錯，或是沒有做過此項檢查。")
-            else:
-                # 判斷主表格是否完全沒有數值
-                df_check = df.replace('--', '').replace('', float('nan')).drop('時間', axis=1)
-                all_empty = df_check.isna().values.all()
-                if all_empty:
-                    st.warning("⚠️ 無法擷取任何數值，可能檢驗格式有錯，或是沒有做過此項檢查。")
-                else:
-                    st.text_area("病歷：", result, height=200)
-                    st.dataframe(df, use_container_width=True)
-                    
-                    # 加上同一天的其他檢驗項目
-                    if target_date:
-                        additional_labs = get_same_day_lab_table(input_text.splitlines(), target_date, exclude_codes=["72-476"])  # 排除GH
-                        if additional_labs.strip():
-                            st.text_area("同一天其他檢驗項目：", additional_labs, height=200)
-                    
-                    # 合併主表格和附加檢驗項目
-                    full_report = result
-                    if target_date:
-                        additional_labs = get_same_day_lab_table(input_text.splitlines(), target_date, exclude_codes=["72-476"])
-                        if additional_labs.strip():
-                            full_report += additional_labs
-                    
-                    st.download_button("下載文字檔", full_report, file_name="clonidine_report.txt")
+def convert_clonidine_lab_text(text, target_date=None, unit_system="conventional"):
+    export = parse_lis_text(text)
+    if export is None:
+        return None
+    return render_clonidine_report(export, target_date, unit_system)
+
+def render_clonidine_report(export, target_date=None, unit_system="conventional"):
+    result = parse_clonidine_gh_five(export, target_date)
+
+    # 檢查是否找到符合條件的資料
+    if result is None:
+        return None
+
+    gh_values, target_date = result
+
+    # 格式化日期
+    if target_date:
+        # 假設日期格式為 YYYYMMDD
+        if len(target_date) == 8:
+            date_fmt = f"{target_date[:4]}/{target_date[4:6]}/{target_date[6:]}"
         else:
-            st.warning("請先貼上原始data！")
+            date_fmt = target_date
+    else:
+        date_fmt = "未知日期"
+    time_labels = ["0'", "30'", "60'", "90'", "120'"]
+    output = io.StringIO()
+    print(f"＝ Clonidine test on {date_fmt} ＝\n", file=output)
+    print(format_with_fixed_width(["", "GH"]), file=output)
+    header_row = ["時間", get_unit("GH", "ng/mL", unit_system)]
+    print(format_with_fixed_width(header_row), file=output)
+    separator = get_dynamic_separator(header_row)
+    print(separator, file=output)
+    table_rows = []
+    for i, label in enumerate(time_labels):
+        row = [label, gh_values[i] if i < len(gh_values) else "--"]
+        table_rows.append(row)
+    if unit_system == "SI":
+        table_rows = convert_table_to_si(table_rows, ["GH"])
+    for row in table_rows:
+        print(format_with_fixed_width(row), file=output)
+    print(separator, file=output)
+    df = pd.DataFrame.from_records(table_rows, columns=["時間", "GH"])
+    # 同一天的其他檢驗項目（排除GH）
+    additional_labs = get_same_day_lab_table(export, target_date, exclude_codes=["72-476"], unit_system=unit_system) if target_date else ""
+    return output.getvalue(), df, target_date, additional_labs
 
-with tabs[2]:
-    st.header("GnRH stimulation test")
-    input_text = st.text_area("貼上原始data：", key="gnrh_input", height=300)
-    if st.button("產生病歷格式", key="gnrh_btn"):
-        if input_text.strip():
-            def parse_gnrh_lh_fsh_five(lines, target_date):
-                
-                start = 0
-                for idx, line in enumerate(lines):
-                    if '\t單位\t參考值' in line:
-                        start = idx+1
-                        break
-                code_map = {"LH": "72-482", "FSH": "72-483", "Testosterone": "72-491", "E2": "72-484"}
-                date_lines = []
-                for l in lines:
-                    if '\t單位\t參考值' in l:
-                        break
-                    date_lines.append(l)
-                lh_list, fsh_list, test_list, e2_list = [], [], [], []
-                for line in lines[start:]:
-                    parts = line.split('\t')
-                    if len(parts) < 6 or parts[0] != 'True':
-                        continue
-                    code = parts[1]
-                    name = parts[2]
-                    # 建立正確的日期-時間對應表，最後一行也要補進來
-                    dt_pairs = []
-                    for i in range(len(date_lines)-1):
-                        date = date_lines[i].split('\t')[-1]
-                        time = date_lines[i+1].split('\t')[0]
-                        dt_pairs.append((date, time))
-                    # 補最後一組（最後一行開頭一定有數字）
-                    last_line_first_col = date_lines[-1].split('\t')[0]
-                    last_line_last_col = date_lines[-1].split('\t')[-1]
-                    dt_pairs.append((last_line_last_col, last_line_first_col))
-                    num_timepoints = len(dt_pairs)
-                    raw_values = parts[4:4+num_timepoints]
-                    # 補齊或截斷
-                    values = [clean_val(v.strip()) if v.strip() else "--" for v in raw_values]
-                    if len(values) < num_timepoints:
-                        values += ["--"] * (num_timepoints - len(values))
-                    elif len(values) > num_timepoints:
-                        values = values[:num_timepoints]
-                    for idx, v in enumerate(values):
-                        dt = ''
-                        if idx < len(dt_pairs):
-                            dt = dt_pairs[idx][0]  # 只抓日期
-                        if dt != target_date:
-                            continue
-                        value_to_store = v
-                        if code == "72-482":
-                            lh_list.append((idx, value_to_store))
-                        elif code == "72-483":
-                            fsh_list.append((idx, value_to_store))
-                        elif code == "72-491":
-                            test_list.append((idx, value_to_store))
-                        elif code == "72-484":
-                            e2_list.append((idx, value_to_store))
-                        print(f"idx={idx}, dt={dt}, v={v}")
-                # LH 和 FSH 各自按照 index 從大到小排序
-                lh_sorted = sorted(lh_list, key=lambda x: x[0], reverse=True)
-                fsh_sorted = sorted(fsh_list, key=lambda x: x[0], reverse=True)
-                
-                # 取各自的前5個
-                lh_top5 = lh_sorted[:5]
-                fsh_top5 = fsh_sorted[:5]
-                
-                # 取得各自的 index
-                lh_idx = [i for i, _ in lh_top5]
-                fsh_idx = [i for i, _ in fsh_top5]
-                # 依各自的 index 取值，補 --，並去除 H/L
-                lh_map = {i: clean_val(v) for i, v in lh_list}
-                fsh_map = {i: clean_val(v) for i, v in fsh_list}
-                test_map = {i: clean_val(v) for i, v in test_list}
-                e2_map = {i: clean_val(v) for i, v in e2_list}
-                
-                # LH 和 FSH 各自使用自己的 index
-                lh_vals = [lh_map.get(i, "--") for i in lh_idx]
-                fsh_vals = [fsh_map.get(i, "--") for i in fsh_idx]
-                
-                # 對於 E2 和 Testosterone，使用 LH 的 index（如果 LH 有資料）
-                common_idx = lh_idx if lh_idx else fsh_idx
-                test_vals = [test_map.get(i, "--") for i in common_idx] if test_list else []
-                e2_vals = [e2_map.get(i, "--") for i in common_idx] if e2_list else []
-                result = {
-                    "LH": lh_vals,
-                    "FSH": fsh_vals,
-                }
-                if test_vals and (test_vals[0] != "--" or (len(test_vals) > 4 and test_vals[4] != "--")):
-                    result["Testosterone"] = test_vals
-                if e2_vals and (e2_vals[0] != "--" or (len(e2_vals) > 4 and e2_vals[4] != "--")):
-                    result["E2"] = e2_vals
-                used_codes = ["72-482", "72-483", "72-491", "72-484"]
-                #print("DEBUG dt_pairs:", dt_pairs)
-                #print("DEBUG target_date:", target_date)
-                return result, common_idx, used_codes
-            def convert_gnrh_lab_text(text):
-                lines = [line.strip() for line in text.splitlines() if line.strip()]
-                # 取得日期
-                date_str = first_yyyymmdd_in_text(" ".join(lines)) or date.today().strftime("%Y%m%d")
-                date_fmt = f"{date_str[:4]}/{date_str[4:6]}/{date_str[6:]}"
-                target_date = date_str
-                result, indices, used_codes = parse_gnrh_lh_fsh_five(lines, target_date)
-                # 讓 time_labels 長度與資料列數一致
-                num_rows = len(next(iter(result.values())))
-                time_labels = [f"{i*30}'" for i in range(num_rows)]
-                output = io.StringIO()
-                col_names = list(result.keys())
-                unit_map = {"LH": "mIU/mL", "FSH": "mIU/mL", "Testosterone": "ng/mL", "E2": "pg/mL"}
-                print(f"＝ GnRH stimulation test on {date_fmt} ＝\n", file=output)
-                print(format_with_fixed_width([""] + col_names), file=output)
-                header_row = ["時間"] + [unit_map.get(n, "") for n in col_names]
-                print(format_with_fixed_width(header_row), file=output)
-                separator = get_dynamic_separator(header_row)
-                print(separator, file=output)
-                table_rows = []
-                for i, label in enumerate(time_labels):
-                    row = [label]
-                    for n in col_names:
-                        row.append(result.get(n, ["--"]*num_rows)[i])
-                    print(format_with_fixed_width(row), file=output)
-                    table_rows.append(row)
-                print(separator, file=output)
-                # debug
-                #print("DEBUG result:", result)
-                #print("DEBUG num_rows:", num_rows)
-                #print("DEBUG time_labels:", time_labels)
-                # 計算 LH peak, FSH peak, ratio
-                def get_peak(vals):
-                    try:
-                        vals_num = []
-                        for x in vals:
-                            if x in ["--", "", None]:
-                                continue
-                            x = x.strip()
-                            # 將 <0.3 這種格式轉成 0.3
-                            m = re.match(r"^<\s*(\d+(?:\.\d+)?)$", x)
-                            if m:
-                                x_clean = m.group(1)
-                            else:
-                                x_clean = x
-                            vals_num.append(float(x_clean))
-                        return max(vals_num) if vals_num else "--"
-                    except Exception as e:
-                        return "--"
-                lh_peak = get_peak(result.get("LH", []))
-                fsh_peak = get_peak(result.get("FSH", []))
-                if isinstance(lh_peak, float) and isinstance(fsh_peak, float) and fsh_peak != 0:
-                    ratio = round(lh_peak / fsh_peak, 2)
+def parse_gnrh_lh_fsh_five(export, target_date):
+    dt_pairs = export["dt_pairs"]
+    num_timepoints = len(dt_pairs)
+    lh_list, fsh_list, test_list, e2_list = [], [], [], []
+    code_lists = {"72-482": lh_list, "72-483": fsh_list, "72-491": test_list, "72-484": e2_list}
+    for code, _, _, values, _, _ in export["rows"]:
+        if code not in code_lists:
+            continue
+        # 補齊或截斷
+        values = [v if v else "--" for v in values[:num_timepoints]]
+        if len(values) < num_timepoints:
+            values += ["--"] * (num_timepoints - len(values))
+        for idx, v in enumerate(values):
+            if dt_pairs[idx][0] != target_date:  # 只抓日期
+                continue
+            code_lists[code].append((idx, v))
+    # LH 和 FSH 各自按照 index 從大到小排序
+    lh_sorted = sorted(lh_list, key=lambda x: x[0], reverse=True)
+    fsh_sorted = sorted(fsh_list, key=lambda x: x[0], reverse=True)
+
+    # 取各自的前5個
+    lh_top5 = lh_sorted[:5]
+    fsh_top5 = fsh_sorted[:5]
+
+    # 取得各自的 index
+    lh_idx = [i for i, _ in lh_top5]
+    fsh_idx = [i for i, _ in fsh_top5]
+    # 依各自的 index 取值，補 --，並去除 H/L
+    lh_map = {i: clean_val(v) for i, v in lh_list}
+    fsh_map = {i: clean_val(v) for i, v in fsh_list}
+    test_map = {i: clean_val(v) for i, v in test_list}
+    e2_map = {i: clean_val(v) for i, v in e2_list}
+
+    # LH 和 FSH 各自使用自己的 index
+    lh_vals = [lh_map.get(i, "--") for i in lh_idx]
+    fsh_vals = [fsh_map.get(i, "--") for i in fsh_idx]
+
+    # 對於 E2 和 Testosterone，使用 LH 的 index（如果 LH 有資料）
+    common_idx = lh_idx if lh_idx else fsh_idx
+    test_vals = [test_map.get(i, "--") for i in common_idx] if test_list else []
+    e2_vals = [e2_map.get(i, "--") for i in common_idx] if e2_list else []
+    result = {
+        "LH": lh_vals,
+        "FSH": fsh_vals,
+    }
+    if test_vals and (test_vals[0] != "--" or (len(test_vals) > 4 and test_vals[4] != "--")):
+        result["Testosterone"] = test_vals
+    if e2_vals and (e2_vals[0] != "--" or (len(e2_vals) > 4 and e2_vals[4] != "--")):
+        result["E2"] = e2_vals
+    used_codes = ["72-482", "72-483", "72-491", "72-484"]
+    #print("DEBUG dt_pairs:", dt_pairs)
+    #print("DEBUG target_date:", target_date)
+    return result, common_idx, used_codes
+
+def convert_gnrh_lab_text(text, target_date=None, unit_system="conventional"):
+    export = parse_lis_text(text)
+    if export is None:
+        return None
+    return render_gnrh_report(export, target_date, unit_system)
+
+def render_gnrh_report(export, target_date=None, unit_system="conventional"):
+    # 取得日期：未指定時取最新一次測試，都沒有則用資料中第一個日期
+    if target_date is None:
+        sessions = find_gnrh_sessions(export)
+        target_date = sessions[0][0] if sessions else export["first_date"]
+    date_str = target_date or date.today().strftime("%Y%m%d")
+    date_fmt = f"{date_str[:4]}/{date_str[4:6]}/{date_str[6:]}"
+    target_date = date_str
+    result, indices, used_codes = parse_gnrh_lh_fsh_five(export, target_date)
+    # 讓 time_labels 長度與資料列數一致
+    num_rows = len(next(iter(result.values())))
+    time_labels = [f"{i*30}'" for i in range(num_rows)]
+    output = io.StringIO()
+    col_names = list(result.keys())
+    unit_map = {"LH": "mIU/mL", "FSH": "mIU/mL", "Testosterone": "ng/mL", "E2": "pg/mL"}
+    print(f"＝ GnRH stimulation test on {date_fmt} ＝\n", file=output)
+    print(format_with_fixed_width([""] + col_names), file=output)
+    header_row = ["時間"] + [get_unit(n, unit_map.get(n, ""), unit_system) for n in col_names]
+    print(format_with_fixed_width(header_row), file=output)
+    separator = get_dynamic_separator(header_row)
+    print(separator, file=output)
+    table_rows = []
+    for i, label in enumerate(time_labels):
+        row = [label]
+        for n in col_names:
+            row.append(result.get(n, ["--"]*num_rows)[i])
+        table_rows.append(row)
+    if unit_system == "SI":
+        table_rows = convert_table_to_si(table_rows, col_names)
+    for row in table_rows:
+        print(format_with_fixed_width(row), file=output)
+    print(separator, file=output)
+    # debug
+    #print("DEBUG result:", result)
+    #print("DEBUG num_rows:", num_rows)
+    #print("DEBUG time_labels:", time_labels)
+    # 計算 LH peak, FSH peak, ratio
+    def get_peak(vals):
+        try:
+            vals_num = []
+            for x in vals:
+                if x in ["--", "", None]:
+                    continue
+                x = x.strip()
+                # 將 <0.3 這種格式轉成 0.3
+                m = re.match(r"^<\s*(\d+(?:\.\d+)?)$", x)
+                if m:
+                    x_clean = m.group(1)
                 else:
-                    ratio = "--"
-                print(f"\n- LH peak: {lh_peak}", file=output)
-                print(f"- FSH peak: {fsh_peak}", file=output)
-                print(f"- peak LH/FSH ratio: {ratio}", file=output)
-                df = pd.DataFrame.from_records(table_rows, columns=["時間"] + col_names)
-                return output.getvalue(), df, lh_peak, fsh_peak, ratio
-            result, df, lh_peak, fsh_peak, ratio = convert_gnrh_lab_text(input_text)
-            # 判斷主表格是否完全沒有數值
-            df_check = df.replace('--', '').replace('', float('nan')).drop('時間', axis=1)
-            all_empty = df_check.isna().values.all()
-            if all_empty:
-                st.warning("⚠️ 無法擷取任何數值，可能檢驗格式有錯，或是沒有做過此項檢查。")
-            else:
-                st.text_area("病歷：", result, height=200)
-                st.dataframe(df, use_container_width=True)
-                st.markdown(f"**LH peak:** {lh_peak}  ")
-                st.markdown(f"**FSH peak:** {fsh_peak}  ")
-                st.markdown(f"**LH/FSH ratio:** {ratio}")
-                st.download_button("下載文字檔", result, file_name="gnrh_report.txt")
-        else:
-            st.warning("請先貼上原始data！")
+                    x_clean = x
+                vals_num.append(float(x_clean))
+            return max(vals_num) if vals_num else "--"
+        except Exception as e:
+            return "--"
+    lh_peak = get_peak(result.get("LH", []))
+    fsh_peak = get_peak(result.get("FSH", []))
+    if isinstance(lh_peak, float) and isinstance(fsh_peak, float) and fsh_peak != 0:
+        ratio = round(lh_peak / fsh_peak, 2)
+    else:
+        ratio = "--"
+    print(f"\n- LH peak: {lh_peak}", file=output)
+    print(f"- FSH peak: {fsh_peak}", file=output)
+    print(f"- peak LH/FSH ratio: {ratio}", file=output)
+    df = pd.DataFrame.from_records(table_rows, columns=["時間"] + col_names)
+    return output.getvalue(), df, lh_peak, fsh_peak, ratio
 
-with tabs[3]:
-    st.header("Glucagon test for C-peptide function")
-    input_text = st.text_area("貼上原始data：", key="glucagon_input", height=300)
-    if st.button("產生病歷格式", key="glucagon_btn"):
-        if input_text.strip():
-            def parse_glucagon_items(lines):
-                start = 0
-                for idx, line in enumerate(lines):
-                    if '\t單位\t參考值' in line:
-                        start = idx+1
-                        break
-                # 取得日期時間對應表
-                date_lines = []
-                for line in lines:
-                    if '\t單位\t參考值' in line:
-                        break
-                    date_lines.append(line)
-                dt_pairs = []
-                for i in range(len(date_lines)-1):
-                    date = date_lines[i].split('\t')[-1]
-                    time = date_lines[i+1].split('\t')[0]
-                    dt_pairs.append((date, time))
-                # 補最後一組
-                last_line_first_col = date_lines[-1].split('\t')[0]
-                last_line_last_col = date_lines[-1].split('\t')[-1]
-                dt_pairs.append((last_line_last_col, last_line_first_col))
-                code_values = {}
-                for line in lines[start:]:
-                    parts = line.split('\t')
-                    if len(parts) < 5 or parts[0] != 'True':
-                        continue
-                    code = parts[1]
-                    # 只處理72-300以上的代碼
-                    if not (code.startswith('72-') and code[3:].isdigit() and int(code[3:]) >= 300):
-                        continue
-                    values = [clean_val(v.strip()) if v.strip() else "" for v in parts[4:]]
-                    code_values[code] = values
-                # 只用 72-314 和 72-497
-                sugar_vals = code_values.get("72-314", [])
-                cpep_vals = code_values.get("72-497", [])
-                # 取得各自有值的 index 與日期
-                sugar_idx_dates = [(i, dt_pairs[i][0]) for i, v in enumerate(sugar_vals) if v and i < len(dt_pairs)]
-                cpep_idx_dates = [(i, dt_pairs[i][0]) for i, v in enumerate(cpep_vals) if v and i < len(dt_pairs)]
-                # 找出同一天最多的日期（以 sugar 為主）
-                from collections import Counter
-                sugar_date_counter = Counter([d for i, d in sugar_idx_dates])
-                cpep_date_counter = Counter([d for i, d in cpep_idx_dates])
-                # 取出有四筆的日期
-                sugar_target_date = next((d for d, c in sugar_date_counter.items() if c >= 4), None)
-                cpep_target_date = next((d for d, c in cpep_date_counter.items() if c >= 4), None)
-                # 以 sugar_target_date 為主，若沒有則用 cpep_target_date
-                target_date = sugar_target_date or cpep_target_date
-                # 取出該日期的 index
-                sugar_indices = [i for i, d in sugar_idx_dates if d == target_date]
-                cpep_indices = [i for i, d in cpep_idx_dates if d == target_date]
-                # 取最新四筆 index，並由大到小
-                sugar_indices = sorted(sugar_indices)[-4:][::-1] if len(sugar_indices) >= 4 else []
-                cpep_indices = sorted(cpep_indices)[-4:][::-1] if len(cpep_indices) >= 4 else []
-                sugar_out = [sugar_vals[i] if i < len(sugar_vals) else "--" for i in sugar_indices] if sugar_indices else ["--"]*4
-                cpep_out = [cpep_vals[i] if i < len(cpep_vals) else "--" for i in cpep_indices] if cpep_indices else ["--"]*4
-                return sugar_out, cpep_out
-            def convert_glucagon_lab_text(text):
-                lines = [line.strip() for line in text.splitlines() if line.strip()]
-                sugar_vals, cpep_vals = parse_glucagon_items(lines)
-                time_labels = ["0'", "3'", "6'", "10'"]
-                output = io.StringIO()
-                print(f"＝ Glucagon test for C-peptide function ＝   \n", file=output)
-                print(format_glucagon_width(["", "C-peptide", "Blood Sugar"]), file=output)
-                header_row = ["時間", "ng/mL", "mg/dL"]
-                print(format_glucagon_width(header_row), file=output)
-                separator = get_glucagon_separator(header_row)
-                print(separator, file=output)
-                table_rows = []
-                for i, label in enumerate(time_labels):
-                    cpep = cpep_vals[i] if i < len(cpep_vals) else "--"
-                    sugar = sugar_vals[i] if i < len(sugar_vals) else "--"
-                    row = [label, cpep, sugar]
-                    print(format_glucagon_width(row), file=output)
-                    table_rows.append(row)
-                print(separator, file=output)
-                # 新增 C-peptide 指標計算
-                def to_float(val):
-                    try:
-                        return float(val)
-                    except:
-                        return None
-                fasting = cpep_vals[0] if len(cpep_vals) > 0 else "--"
-                post6 = cpep_vals[2] if len(cpep_vals) > 2 else "--"
-                cpep_floats = [to_float(x) for x in cpep_vals if to_float(x) is not None]
-                cpep_floats_clean = [x for x in cpep_floats if x is not None]
-                peak = max(cpep_floats_clean) if cpep_floats_clean else "--"
-                fasting_float = to_float(fasting)
-                delta = round(peak - fasting_float, 2) if (peak != "--" and fasting_float is not None) else "--"
-                print("\nFasting C-peptide:  {} ng/mL".format(fasting), file=output)
-                print("6' post-glucagon C-peptide:  {} ng/mL".format(post6), file=output)
-                print("Stimulated peak C-peptide:  {} ng/mL".format(peak), file=output)
-                print("ΔCP ＝  {} ng/mL".format(delta), file=output)
-                df = pd.DataFrame.from_records(table_rows, columns=["時間", "C-peptide", "Blood Sugar"])
-                appendix = '''\
+def parse_glucagon_items(export, target_date=None):
+    code_values = {}
+    for code, _, _, values, _, _ in export["rows"]:
+        # 只處理72-300以上的代碼
+        if not is_report_code(code):
+            continue
+        code_values[code] = values
+    # 只用 72-314 和 72-497
+    sugar_vals = code_values.get("72-314", [])
+    cpep_vals = code_values.get("72-497", [])
+    # 未指定日期時取最新一次有四筆的測試
+    if target_date is None:
+        sessions = find_glucagon_sessions(export)
+        target_date = sessions[0][0] if sessions else None
+    # 取出該日期有值的 index
+    by_date = index_values_by_date(export)
+    sugar_indices = by_date.get("72-314", {}).get(target_date, [])
+    cpep_indices = by_date.get("72-497", {}).get(target_date, [])
+    # 取最新四筆 index，並由大到小
+    sugar_indices = sorted(sugar_indices)[-4:][::-1] if len(sugar_indices) >= 4 else []
+    cpep_indices = sorted(cpep_indices)[-4:][::-1] if len(cpep_indices) >= 4 else []
+    sugar_out = [sugar_vals[i] if i < len(sugar_vals) else "--" for i in sugar_indices] if sugar_indices else ["--"]*4
+    cpep_out = [cpep_vals[i] if i < len(cpep_vals) else "--" for i in cpep_indices] if cpep_indices else ["--"]*4
+    return sugar_out, cpep_out
+
+GLUCAGON_APPENDIX = '''\
 \n********************************************************************   
 2022年第一型糖尿病申請全民健保重大傷病依據   
 C-peptide/glucagon test(residual insulin function)(NTUH)   
@@ -845,16 +951,389 @@ Peak and fasting C-peptide level
 - NIDDM: peak CP ≧ 1.5 ng/dl or fasting CP ≧ 1 ng/dl    
 ******************************************************************** 
 '''
-                return output.getvalue() + appendix, df
-            result, df = convert_glucagon_lab_text(input_text)
-            # 判斷主表格是否完全沒有數值
-            df_check = df.replace('--', '').replace('', float('nan')).drop('時間', axis=1)
-            all_empty = df_check.isna().values.all()
-            if all_empty:
+
+def convert_glucagon_lab_text(text, target_date=None, unit_system="conventional"):
+    export = parse_lis_text(text)
+    if export is None:
+        return None
+    return render_glucagon_report(export, target_date, unit_system)
+
+def render_glucagon_report(export, target_date=None, unit_system="conventional"):
+    sugar_vals, cpep_vals = parse_glucagon_items(export, target_date)
+    # C-peptide 指標與下方判讀標準都是 ng/mL，SI 模式只換算表格
+    cpep_ng = cpep_vals
+    if unit_system == "SI":
+        cpep_vals = convert_values_to_si(cpep_vals, ["C-peptide"] * len(cpep_vals))
+        sugar_vals = convert_values_to_si(sugar_vals, ["Blood Sugar"] * len(sugar_vals))
+    cpep_unit = get_unit("C-peptide", "ng/mL", unit_system)
+    time_labels = ["0'", "3'", "6'", "10'"]
+    output = io.StringIO()
+    print(f"＝ Glucagon test for C-peptide function ＝   \n", file=output)
+    print(format_glucagon_width(["", "C-peptide", "Blood Sugar"]), file=output)
+    header_row = ["時間", cpep_unit, get_unit("Blood Sugar", "mg/dL", unit_system)]
+    print(format_glucagon_width(header_row), file=output)
+    separator = get_glucagon_separator(header_row)
+    print(separator, file=output)
+    table_rows = []
+    for i, label in enumerate(time_labels):
+        cpep = cpep_vals[i] if i < len(cpep_vals) else "--"
+        sugar = sugar_vals[i] if i < len(sugar_vals) else "--"
+        row = [label, cpep, sugar]
+        print(format_glucagon_width(row), file=output)
+        table_rows.append(row)
+    print(separator, file=output)
+    # 新增 C-peptide 指標計算
+    def to_float(val):
+        try:
+            return float(val)
+        except:
+            return None
+    fasting = cpep_ng[0] if len(cpep_ng) > 0 else "--"
+    post6 = cpep_ng[2] if len(cpep_ng) > 2 else "--"
+    cpep_floats = [to_float(x) for x in cpep_ng if to_float(x) is not None]
+    cpep_floats_clean = [x for x in cpep_floats if x is not None]
+    peak = max(cpep_floats_clean) if cpep_floats_clean else "--"
+    fasting_float = to_float(fasting)
+    delta = round(peak - fasting_float, 2) if (peak != "--" and fasting_float is not None) else "--"
+    if unit_system == "SI":
+        print(f"\n※ 以下 C-peptide 指標與判讀標準為 ng/mL（1 ng/mL = {SI_CONVERSIONS['C-peptide'][2]} {cpep_unit}）", file=output)
+    print("\nFasting C-peptide:  {} ng/mL".format(fasting), file=output)
+    print("6' post-glucagon C-peptide:  {} ng/mL".format(post6), file=output)
+    print("Stimulated peak C-peptide:  {} ng/mL".format(peak), file=output)
+    print("ΔCP ＝  {} ng/mL".format(delta), file=output)
+    df = pd.DataFrame.from_records(table_rows, columns=["時間", "C-peptide", "Blood Sugar"])
+    return output.getvalue() + GLUCAGON_APPENDIX, df
+
+# 批次轉換（ingest_daemon.py）低記憶體模式下各檢查保留的項目；Insulin 與 Clonidine 的同日檢驗表格需要所有 72-300 以上的項目
+# 頁面有「其他日期的檢驗項目」選單，一律保留所有 72-300 以上的項目（見 parse_input）
+LOW_MEMORY_KEEP_CODES = {
+    "insulin": is_report_code,
+    "clonidine": is_report_code,
+    "gnrh": frozenset(["72-482", "72-483", "72-491", "72-484"]).__contains__,
+    "glucagon": frozenset(["72-314", "72-497"]).__contains__,
+}
+
+# 趨勢圖每個項目最多顯示的點數
+TREND_MAX_POINTS = 300
+
+def to_number(v):
+    """檢驗值轉成數字，<0.3、>1000 這類設限值取其數值，無法轉換回傳 None"""
+    m = re.match(r"^[<>]?\s*(\d+(?:\.\d+)?)$", v.strip())
+    return float(m.group(1)) if m else None
+
+def parse_timepoint(date_str, time_str):
+    """日期（YYYYMMDD）加時間（HHMM）轉成 Timestamp，時間無法辨識時只用日期"""
+    digits = re.sub(r"\D", "", time_str)
+    try:
+        if len(digits) == 4:
+            return pd.Timestamp(f"{date_str} {digits[:2]}:{digits[2:]}")
+        return pd.Timestamp(date_str)
+    except ValueError:
+        return None
+
+def build_trend_series(export):
+    """把每個檢驗項目的所有數值整理成依時間排序的序列：code -> (name, unit, times, values)"""
+    timepoints = [parse_timepoint(d, t) for d, t in export["dt_pairs"]]
+    series = {}
+    for code, name, _, values, unit, _ in export["rows"]:
+        if not is_report_code(code):
+            continue
+        points = []
+        for i, v in enumerate(values):
+            if not v or i >= len(timepoints) or timepoints[i] is None:
+                continue
+            num = to_number(v)
+            if num is not None:
+                points.append((timepoints[i], num))
+        if points:
+            points.sort(key=lambda p: p[0])
+            series[code] = (name, unit, [p[0] for p in points], [p[1] for p in points])
+    return series
+
+def lttb_downsample(xs, ys, threshold):
+    """Largest-Triangle-Three-Buckets 降採樣，回傳保留的 index（保留頭尾與每個區間中最突出的點）"""
+    n = len(xs)
+    if threshold >= n or threshold < 3:
+        return list(range(n))
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    every = (n - 2) / (threshold - 2)
+    sampled = [0]
+    a = 0
+    for i in range(threshold - 2):
+        # 下一個區間的平均點
+        avg_start = int((i + 1) * every) + 1
+        avg_end = min(int((i + 2) * every) + 1, n)
+        avg_x = xs[avg_start:avg_end].mean()
+        avg_y = ys[avg_start:avg_end].mean()
+        # 目前區間中與前一個選取點、下一區間平均點構成最大三角形的點
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        area = np.abs((xs[a] - avg_x) * (ys[start:end] - ys[a]) - (xs[a] - xs[start:end]) * (avg_y - ys[a]))
+        a = start + int(area.argmax())
+        sampled.append(a)
+    sampled.append(n - 1)
+    return sampled
+
+@st.cache_data(max_entries=8)
+def get_trend_series(text):
+    """每一份匯出各自的趨勢序列（無法辨識的為空 dict）
+
+    多份匯出可能是不同病人，序列不合併
+    """
+    pool = get_parse_pool() if PARSE_WORKERS > 1 else None
+    return [build_trend_series(export) if export is not None else {} for export in parse_exports(text, pool=pool)]
+
+@st.cache_data(max_entries=256)
+def get_downsampled_trend(text, seg_idx, code, max_points=TREND_MAX_POINTS):
+    """單一項目降採樣後的趨勢，依 (資料, 第幾份, code) 快取，切換項目不需重新計算"""
+    name, unit, times, values = get_trend_series(text)[seg_idx][code]
+    xs = [t.value for t in times]
+    keep = lttb_downsample(xs, values, max_points)
+    return pd.DataFrame({f"{name} ({unit})": [values[i] for i in keep]}, index=pd.DatetimeIndex([times[i] for i in keep], name="時間"))
+
+def parse_input(input_text):
+    """頁面按下按鈕時的解析流程，回傳 (exports, 解析記憶體峰值, 是否低記憶體模式)
+
+    預估超出記憶體預算時改用低記憶體模式；沒有開啟 MEASURE_MEMORY 時峰值為 None
+    """
+    low_memory = use_low_memory(input_text)
+    # 每個頁面都有檢驗日期選單，需要所有 72-300 以上的項目，低記憶體模式的報告與選單才與一般模式相同
+    keep_code = is_report_code if low_memory else None
+    pool = get_parse_pool() if PARSE_WORKERS > 1 else None
+    exports, parse_peak = maybe_measure_peak_memory(parse_exports, input_text, keep_code=keep_code, pool=pool)
+    return exports, parse_peak, low_memory
+
+def parse_for_tab(tab, input_text):
+    """解析結果存在 session_state，只另存輸入的 hash（原文已在輸入框中）與這次解析的編號
+
+    解析編號加在結果與選單的 key 中，換了資料時 Streamlit 不會沿用上一份資料的輸入框內容
+    """
+    parse_id = st.session_state.get("parse_id", 0) + 1
+    st.session_state["parse_id"] = parse_id
+    st.session_state[f"{tab}_exports"] = (hash(input_text), parse_id) + parse_input(input_text)
+
+def get_parsed_exports(tab, input_text):
+    """取出按下按鈕時解析好的資料 (exports, 解析記憶體峰值, 是否低記憶體模式, 解析編號)
+
+    輸入已修改則刪除舊結果，不佔用記憶體也不顯示
+    """
+    saved = st.session_state.get(f"{tab}_exports")
+    if saved and saved[0] == hash(input_text):
+        exports, parse_peak, low_memory = saved[2:]
+        return exports, parse_peak, low_memory, saved[1]
+    if saved:
+        del st.session_state[f"{tab}_exports"]
+    return [], None, False, 0
+
+def show_memory_usage(parse_peak, render_peak, low_memory):
+    mode = "（低記憶體模式）" if low_memory else ""
+    if parse_peak is None and render_peak is None:
+        if low_memory:
+            st.caption("低記憶體模式")
+        return
+    # 與其他量測同時進行時沒有數值
+    fmt = lambda peak: "--" if peak is None else f"{peak / 2**20:.2f} MB"
+    st.caption(f"記憶體峰值：解析 {fmt(parse_peak)}，產生報告 {fmt(render_peak)}{mode}")
+
+def select_test_session(sessions, key):
+    """有多次測試時顯示日期選單（含完整度），回傳選取的日期；沒有測試時回傳 None"""
+    if len(sessions) <= 1:
+        return sessions[0][0] if sessions else None
+    scores = dict(sessions)
+    return st.selectbox("測試日期：", [d for d, _ in sessions], format_func=lambda d: f"{d[:4]}/{d[4:6]}/{d[6:]}（完整度 {scores[d]:.0%}）", key=key)
+
+def show_lab_date_picker(export, unit_system, key):
+    """選擇任一天查看當天所有檢驗項目，由預先整理的日期索引直接查表"""
+    lab_dates = get_lab_dates(export)
+    if not lab_dates:
+        return
+    with st.expander("查看其他日期的檢驗項目"):
+        lab_date = st.selectbox("檢驗日期：", lab_dates, format_func=lambda d: f"{d[:4]}/{d[4:6]}/{d[6:]}", key=key)
+        st.text_area("當天檢驗項目：", get_same_day_lab_table(export, lab_date, unit_system=unit_system), height=200, key=f"{key}_{lab_date}_{unit_system}")
+
+# 單位系統（所有頁面共用），切換時直接由已解析的資料重新產生報告
+unit_system = st.radio("單位：", list(UNIT_SYSTEMS), format_func=UNIT_SYSTEMS.get, horizontal=True, key="unit_system")
+
+# 頁面切換（改用 tabs）
+tabs = st.tabs(["Insulin/TRH/GnRH test", "Clonidine test", "GnRH stimulation test", "Glucagon test for C-peptide function", "Trend"])
+
+with tabs[0]:
+    st.header("Insulin/TRH/GnRH test")
+    use_glucagon_time = st.checkbox("將insulin改為glucagon")
+    input_text = st.text_area("貼上原始data：", height=300)
+    if st.button("產生病歷格式", key="insulin_btn"):
+        if not input_text.strip():
+            st.warning("請先貼上原始data！")
+        elif sniff_lis_text(input_text) is None:
+            st.warning("⚠️ 無法辨識的檢驗資料格式，請使用新版檢驗報告複製後貼上。")
+        else:
+            # 解析結果存在 session_state，切換測試日期時不需重新解析
+            parse_for_tab("insulin", input_text)
+    exports, parse_peak, low_memory, parse_id = get_parsed_exports("insulin", input_text)
+    time_labels = ["-1'", "30'", "60'", "90'", "120'", "150'", "180'"] if use_glucagon_time else FIXED_TIME_LABELS
+    for seg_idx, export in enumerate(exports):
+        # 多份資料時分開顯示
+        if len(exports) > 1:
+            st.subheader(f"第 {seg_idx+1} 份資料")
+        if export is None:
+            st.warning("⚠️ 無法辨識的檢驗資料格式，請使用新版檢驗報告複製後貼上。")
+            continue
+        target_date = select_test_session(find_insulin_sessions(export), key=f"insulin_session_{parse_id}_{seg_idx}")
+        (result, df, full_df), render_peak = maybe_measure_peak_memory(render_common_seven_report, export, time_labels=time_labels, glucagon_title=use_glucagon_time, target_date=target_date, full_matrix=not low_memory, unit_system=unit_system)
+        # 判斷主表格是否完全沒有數值
+        df_check = df.replace('--', '').replace('', float('nan')).drop('時間', axis=1)
+        all_empty = df_check.isna().values.all()
+        if all_empty:
+            st.warning("⚠️ 無法擷取任何數值，可能檢驗格式有錯，或是沒有做過此項檢查。")
+        #st.write("完整表格（所有檢驗項目 x 所有時間點）：")
+        #st.dataframe(full_df, use_container_width=True)
+        if not all_empty:
+            st.text_area("病歷：", result, height=300, key=f"insulin_result_{parse_id}_{seg_idx}_{target_date}_{use_glucagon_time}_{unit_system}")
+            st.dataframe(df, use_container_width=True)
+            st.download_button("下載文字檔", result, file_name="converted_report.txt", key=f"insulin_download_{parse_id}_{seg_idx}")
+            show_memory_usage(parse_peak, render_peak, low_memory)
+            show_lab_date_picker(export, unit_system, key=f"insulin_lab_date_{parse_id}_{seg_idx}")
+
+with tabs[1]:
+    st.header("Clonidine test")
+    input_text = st.text_area("貼上原始data：", key="clonidine_input", height=300)
+    if st.button("產生病歷格式", key="clonidine_btn"):
+        if not input_text.strip():
+            st.warning("請先貼上原始data！")
+        elif sniff_lis_text(input_text) is None:
+            st.warning("⚠️ 無法辨識的檢驗資料格式，請使用新版檢驗報告複製後貼上。")
+        else:
+            # 解析結果存在 session_state，切換測試日期時不需重新解析
+            parse_for_tab("clonidine", input_text)
+    exports, parse_peak, low_memory, parse_id = get_parsed_exports("clonidine", input_text)
+    for seg_idx, export in enumerate(exports):
+        # 多份資料時分開顯示
+        if len(exports) > 1:
+            st.subheader(f"第 {seg_idx+1} 份資料")
+        if export is None:
+            st.warning("⚠️ 無法辨識的檢驗資料格式，請使用新版檢驗報告複製後貼上。")
+            continue
+        target_date = select_test_session(find_clonidine_sessions(export), key=f"clonidine_session_{parse_id}_{seg_idx}")
+        converted, render_peak = maybe_measure_peak_memory(render_clonidine_report, export, target_date, unit_system)
+
+        # 檢查是否找到符合條件的資料
+        if converted is None:
+            st.warning("⚠️ 無法擷取任何數值，可能檢驗格式有錯，或是沒有做過此項檢查。")
+            continue
+        result, df, target_date, additional_labs = converted
+        # 判斷主表格是否完全沒有數值
+        df_check = df.replace('--', '').replace('', float('nan')).drop('時間', axis=1)
+        all_empty = df_check.isna().values.all()
+        if all_empty:
+            st.warning("⚠️ 無法擷取任何數值，可能檢驗格式有錯，或是沒有做過此項檢查。")
+        else:
+            st.text_area("病歷：", result, height=200, key=f"clonidine_result_{parse_id}_{seg_idx}_{target_date}_{unit_system}")
+            st.dataframe(df, use_container_width=True)
+
+            # 加上同一天的其他檢驗項目
+            if additional_labs.strip():
+                st.text_area("同一天其他檢驗項目：", additional_labs, height=200, key=f"clonidine_labs_{parse_id}_{seg_idx}_{target_date}_{unit_system}")
+
+            # 合併主表格和附加檢驗項目
+            full_report = result
+            if additional_labs.strip():
+                full_report += additional_labs
+
+            st.download_button("下載文字檔", full_report, file_name="clonidine_report.txt", key=f"clonidine_download_{parse_id}_{seg_idx}")
+            show_memory_usage(parse_peak, render_peak, low_memory)
+            show_lab_date_picker(export, unit_system, key=f"clonidine_lab_date_{parse_id}_{seg_idx}")
+
+with tabs[2]:
+    st.header("GnRH stimulation test")
+    input_text = st.text_area("貼上原始data：", key="gnrh_input", height=300)
+    if st.button("產生病歷格式", key="gnrh_btn"):
+        if not input_text.strip():
+            st.warning("請先貼上原始data！")
+        elif sniff_lis_text(input_text) is None:
+            st.warning("⚠️ 無法辨識的檢驗資料格式，請使用新版檢驗報告複製後貼上。")
+        else:
+            # 解析結果存在 session_state，切換測試日期時不需重新解析
+            parse_for_tab("gnrh", input_text)
+    exports, parse_peak, low_memory, parse_id = get_parsed_exports("gnrh", input_text)
+    for seg_idx, export in enumerate(exports):
+        # 多份資料時分開顯示
+        if len(exports) > 1:
+            st.subheader(f"第 {seg_idx+1} 份資料")
+        if export is None:
+            st.warning("⚠️ 無法辨識的檢驗資料格式，請使用新版檢驗報告複製後貼上。")
+            continue
+        target_date = select_test_session(find_gnrh_sessions(export), key=f"gnrh_session_{parse_id}_{seg_idx}")
+        (result, df, lh_peak, fsh_peak, ratio), render_peak = maybe_measure_peak_memory(render_gnrh_report, export, target_date, unit_system)
+        # 判斷主表格是否完全沒有數值
+        df_check = df.replace('--', '').replace('', float('nan')).drop('時間', axis=1)
+        all_empty = df_check.isna().values.all()
+        if all_empty:
+            st.warning("⚠️ 無法擷取任何數值，可能檢驗格式有錯，或是沒有做過此項檢查。")
+        else:
+            st.text_area("病歷：", result, height=200, key=f"gnrh_result_{parse_id}_{seg_idx}_{target_date}_{unit_system}")
+            st.dataframe(df, use_container_width=True)
+            st.markdown(f"**LH peak:** {lh_peak}  ")
+            st.markdown(f"**FSH peak:** {fsh_peak}  ")
+            st.markdown(f"**LH/FSH ratio:** {ratio}")
+            st.download_button("下載文字檔", result, file_name="gnrh_report.txt", key=f"gnrh_download_{parse_id}_{seg_idx}")
+            show_memory_usage(parse_peak, render_peak, low_memory)
+            show_lab_date_picker(export, unit_system, key=f"gnrh_lab_date_{parse_id}_{seg_idx}")
+
+with tabs[3]:
+    st.header("Glucagon test for C-peptide function")
+    input_text = st.text_area("貼上原始data：", key="glucagon_input", height=300)
+    if st.button("產生病歷格式", key="glucagon_btn"):
+        if not input_text.strip():
+            st.warning("請先貼上原始data！")
+        elif sniff_lis_text(input_text) is None:
+            st.warning("⚠️ 無法辨識的檢驗資料格式，請使用新版檢驗報告複製後貼上。")
+        else:
+            # 解析結果存在 session_state，切換測試日期時不需重新解析
+            parse_for_tab("glucagon", input_text)
+    exports, parse_peak, low_memory, parse_id = get_parsed_exports("glucagon", input_text)
+    for seg_idx, export in enumerate(exports):
+        # 多份資料時分開顯示
+        if len(exports) > 1:
+            st.subheader(f"第 {seg_idx+1} 份資料")
+        if export is None:
+            st.warning("⚠️ 無法辨識的檢驗資料格式，請使用新版檢驗報告複製後貼上。")
+            continue
+        target_date = select_test_session(find_glucagon_sessions(export), key=f"glucagon_session_{parse_id}_{seg_idx}")
+        (result, df), render_peak = maybe_measure_peak_memory(render_glucagon_report, export, target_date, unit_system)
+        # 判斷主表格是否完全沒有數值
+        df_check = df.replace('--', '').replace('', float('nan')).drop('時間', axis=1)
+        all_empty = df_check.isna().values.all()
+        if all_empty:
+            st.warning("⚠️ 無法擷取任何數值，可能檢驗格式有錯，或是沒有做過此項檢查。")
+        else:
+            st.text_area("病歷：", result, height=200, key=f"glucagon_result_{parse_id}_{seg_idx}_{target_date}_{unit_system}")
+            st.dataframe(df, use_container_width=True)
+            st.download_button("下載文字檔", result, file_name="glucagon_report.txt", key=f"glucagon_download_{parse_id}_{seg_idx}")
+            show_memory_usage(parse_peak, render_peak, low_memory)
+            show_lab_date_picker(export, unit_system, key=f"glucagon_lab_date_{parse_id}_{seg_idx}")
+
+with tabs[4]:
+    st.header("Trend")
+    input_text = st.text_area("貼上原始data：", key="trend_input", height=300)
+    if input_text.strip():
+        if sniff_lis_text(input_text) is None:
+            st.warning("⚠️ 無法辨識的檢驗資料格式，請使用新版檢驗報告複製後貼上。")
+        else:
+            all_series = get_trend_series(input_text)
+            seg_choices = [seg_idx for seg_idx, series in enumerate(all_series) if series]
+            if not seg_choices:
                 st.warning("⚠️ 無法擷取任何數值，可能檢驗格式有錯，或是沒有做過此項檢查。")
             else:
-                st.text_area("病歷：", result, height=200)
-                st.dataframe(df, use_container_width=True)
-                st.download_button("下載文字檔", result, file_name="glucagon_report.txt")
-        else:
-            st.warning("請先貼上原始data！")
\ No newline at end of file
+                # 選單的 key 加上資料的 hash，換了資料時不沿用上一份資料的選擇
+                trend_key = hash(input_text)
+                # 多份資料時分開顯示，一次只畫其中一份
+                if len(all_series) > 1:
+                    seg_idx = st.selectbox("資料：", seg_choices, format_func=lambda i: f"第 {i+1} 份資料", key=f"trend_segment_{trend_key}")
+                else:
+                    seg_idx = seg_choices[0]
+                trend_series = all_series[seg_idx]
+                trend_code = st.selectbox("檢驗項目：", sorted(trend_series), format_func=lambda c: f"{trend_series[c][0]} ({c})", key=f"trend_code_{trend_key}_{seg_idx}")
+                trend_df = get_downsampled_trend(input_text, seg_idx, trend_code)
+                st.line_chart(trend_df)
+                st.caption(f"共 {len(trend_series[trend_code][2])} 筆，顯示 {len(trend_df)} 點")
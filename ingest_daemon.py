@@ -0,0 +1,384 @@
+"""監看資料夾：LIS 匯出檔放進資料夾後自動產生病歷格式
+
+定期掃描資料夾，新檔案排入佇列後交給多個 worker 行程轉換（含多份匯出的大檔案分段平行轉換），報告以原子寫入方式存在輸入檔旁邊
+（例如 patient.txt -> patient.clonidine_report.txt）。已處理的檔案記錄在 manifest，重新啟動不會重做。
+
+用法：
+    python ingest_daemon.py /shared/lis_export
+    python ingest_daemon.py /shared/lis_export --workers 4 --max-queue 64 --tests insulin gnrh
+    python ingest_daemon.py /shared/lis_export --once
+"""
+import argparse
+import fnmatch
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import streamlit.logger
+
+# 直接 import app 時不需要 bare mode 的警告訊息
+streamlit.logger.set_log_level("error")
+
+import Endocrine_report as er
+
+TESTS = ["insulin", "clonidine", "gnrh", "glucagon"]
+MANIFEST_NAME = ".ingest_manifest.json"
+REPORT_SUFFIX = "_report.txt"
+# 這裡產生的報告檔名，例如 patient.gnrh_report.txt、patient.2.labs_report.txt
+REPORT_NAME_RE = re.compile(r"\.(?:insulin|clonidine|gnrh|glucagon|labs)_report\.txt$")
+# LIS 匯出檔可能是 UTF-8 或 Big5
+INPUT_ENCODINGS = ["utf-8-sig", "cp950"]
+# 超過此大小且含多份匯出的檔案先在主行程分段，各份交給不同 worker 平行轉換（約 5000 行）
+FANOUT_MIN_BYTES = 256 * 1024
+# worker 行程異常結束（例如記憶體不足被系統終止）時，同一個檔案最多重試的次數
+MAX_CRASH_RETRIES = 3
+# 各檢查的測試日期判斷，找不到測試時不產生該報告
+SESSION_FINDERS = {
+    "insulin": er.find_insulin_sessions,
+    "clonidine": er.find_clonidine_sessions,
+    "gnrh": er.find_gnrh_sessions,
+    "glucagon": er.find_glucagon_sessions,
+}
+
+log = logging.getLogger("ingest")
+
+
+def read_export(path):
+    with open(path, "rb") as f:
+        raw = f.read()
+    for encoding in INPUT_ENCODINGS:
+        try:
+            return raw.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    return raw.decode("utf-8", errors="replace")
+
+
+def _current_umask():
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+# mkstemp 建立的檔案權限為 0600，改成一般新檔案的權限，共用資料夾的其他使用者才讀得到
+FILE_MODE = 0o666 & ~_current_umask()
+
+
+def write_atomic(path, content):
+    """先寫到同一資料夾的暫存檔再 rename，讀取端不會看到寫到一半的檔案"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".", suffix=".tmp")
+    try:
+        os.chmod(tmp_path, FILE_MODE)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def has_values(df):
+    # 與頁面相同：主表格完全沒有數值就不輸出
+    df_check = df.replace('--', '').replace('', float('nan')).drop('時間', axis=1)
+    return not df_check.isna().values.all()
+
+
+def render_report(test, export, unit_system="conventional"):
+    """產生與頁面下載檔相同的病歷文字（最新一次測試），沒有該項測試或沒有數值時回傳 None"""
+    if not SESSION_FINDERS[test](export):
+        return None
+    if test == "insulin":
+        result, df, _ = er.render_common_seven_report(export, full_matrix=False, unit_system=unit_system)
+    elif test == "clonidine":
+        converted = er.render_clonidine_report(export, unit_system=unit_system)
+        if converted is None:
+            return None
+        result, df, _, additional_labs = converted
+        if additional_labs.strip():
+            result += additional_labs
+    elif test == "gnrh":
+        result, df = er.render_gnrh_report(export, unit_system=unit_system)[:2]
+    else:
+        result, df = er.render_glucagon_report(export, unit_system=unit_system)
+    return result if has_values(df) else None
+
+
+def process_file(path, tests, memory_budget_mb=0, unit_system="conventional", same_day_panels=False):
+    """worker 行程：轉換單一檔案並量測記憶體峰值，回傳 (狀態, 產生的報告檔名, 峰值 bytes)"""
+    text = read_export(path)
+    if er.sniff_lis_text(text) is None:
+        return "unrecognized", [], 0
+    (status, reports), peak = er.measure_peak_memory(convert_file, path, text, tests, memory_budget_mb, unit_system, same_day_panels)
+    return status, reports, peak
+
+
+def process_segment(prefix, segment, tests, unit_system="conventional", same_day_panels=False):
+    """worker 行程：轉換大檔案分段後的其中一份，回傳值與 process_file 相同"""
+    reports, peak = er.measure_peak_memory(convert_segment, prefix, segment, tests, None, unit_system, same_day_panels)
+    return ("ok" if reports else "empty"), reports, peak
+
+
+def convert_file(path, text, tests, memory_budget_mb, unit_system, same_day_panels):
+    keep_code = None
+    # 預估超出記憶體預算時只保留要產生的報告用得到的項目
+    if er.use_low_memory(text, memory_budget_mb):
+        keeps = [er.LOW_MEMORY_KEEP_CODES[test] for test in tests]
+        if same_day_panels:
+            keeps.append(er.is_report_code)
+        keep_code = lambda code: any(keep(code) for keep in keeps)
+    segments = er.split_lis_exports(er.split_lab_lines(text))
+    reports = []
+    for seg_idx, segment in enumerate(segments):
+        prefix = report_prefix(path, seg_idx, len(segments))
+        reports += convert_segment(prefix, segment, tests, keep_code, unit_system, same_day_panels)
+    return ("ok" if reports else "empty"), reports
+
+
+def report_prefix(path, seg_idx, n_segments):
+    # 一個檔案含多份匯出時，報告檔名加上序號
+    stem = os.path.splitext(path)[0]
+    return stem if n_segments == 1 else f"{stem}.{seg_idx+1}"
+
+
+def convert_segment(prefix, segment, tests, keep_code, unit_system, same_day_panels):
+    """轉換一份匯出並寫出報告，回傳產生的報告檔名"""
+    export = er.parse_lis_export(segment, keep_code)
+    if export is None:
+        return []
+    reports = []
+    for test in tests:
+        report = render_report(test, export, unit_system)
+        if report is None:
+            continue
+        report_path = f"{prefix}.{test}{REPORT_SUFFIX}"
+        write_atomic(report_path, report)
+        reports.append(os.path.basename(report_path))
+    # 所有日期的同日檢驗表格寫在同一個檔案
+    if same_day_panels:
+        panels = er.render_same_day_panels(export, unit_system)
+        if panels:
+            report_path = f"{prefix}.labs{REPORT_SUFFIX}"
+            write_atomic(report_path, panels)
+            reports.append(os.path.basename(report_path))
+    return reports
+
+
+def split_for_fanout(path, size, memory_budget_mb):
+    """大檔案在主行程讀取並分段，含多份匯出時回傳各份（交給不同 worker），其餘回傳 None
+
+    低記憶體模式的檔案不拆分，仍由單一 worker 依序轉換
+    """
+    if size < FANOUT_MIN_BYTES:
+        return None
+    text = read_export(path)
+    if er.sniff_lis_text(text) is None or er.use_low_memory(text, memory_budget_mb):
+        return None
+    segments = er.split_lis_exports(er.split_lab_lines(text))
+    return segments if len(segments) > 1 else None
+
+
+def load_manifest(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def scan(watch_dir, pattern, manifest, queued, limit, settle, skipped=None):
+    """找出尚未處理且已寫完（超過 settle 秒未變動）的檔案，最多 limit 個
+
+    檔名以 _report.txt 結尾但不是這裡產生的檔案也會跳過，並記錄一次（skipped）
+    """
+    found = []
+    now = time.time()
+    with os.scandir(watch_dir) as entries:
+        for entry in sorted(entries, key=lambda e: e.name):
+            if len(found) >= limit:
+                break
+            name = entry.name
+            if (name.startswith(".") or name in queued
+                    or not entry.is_file() or not fnmatch.fnmatch(name, pattern)):
+                continue
+            if name.endswith(REPORT_SUFFIX):
+                if not REPORT_NAME_RE.search(name) and skipped is not None and name not in skipped:
+                    skipped.add(name)
+                    log.warning("%s: skipped, file names ending in %s are reserved for reports", name, REPORT_SUFFIX)
+                continue
+            stat = entry.stat()
+            if now - stat.st_mtime < settle:
+                continue
+            record = manifest.get(name)
+            if record and (record["mtime_ns"], record["size"]) == (stat.st_mtime_ns, stat.st_size):
+                continue
+            found.append(name)
+    return found
+
+
+def run(watch_dir, pattern="*.txt", tests=TESTS, workers=2, max_queue=32, poll_interval=2.0,
+        settle=2.0, metrics_interval=30.0, once=False, memory_budget_mb=0, unit_system="conventional",
+        same_day_panels=False):
+    manifest_path = os.path.join(watch_dir, MANIFEST_NAME)
+    manifest = load_manifest(manifest_path)
+    queue = deque()
+    queued = set()
+    skipped = set()
+    in_flight = {}
+    # 每個檔案尚未完成的工作數與各工作的結果（大檔案拆成多個工作）
+    jobs = {}
+    crashes = {}
+    processed = errors = 0
+    started = last_metrics = time.monotonic()
+
+    pool = ProcessPoolExecutor(max_workers=workers)
+    try:
+        while True:
+            # 佇列已滿時不再掃描新檔案（backpressure），留待下一輪
+            room = max_queue - len(queue) - len(in_flight)
+            if room > 0:
+                for name in scan(watch_dir, pattern, manifest, queued, room, 0 if once else settle, skipped):
+                    queue.append(name)
+                    queued.add(name)
+            broken = False
+            while queue and len(in_flight) < workers:
+                # 曾讓 worker 異常結束的檔案單獨重試，不連累其他檔案，也能確定是哪個檔案造成
+                if crashes.get(queue[0]) and in_flight:
+                    break
+                name = queue.popleft()
+                path = os.path.join(watch_dir, name)
+                try:
+                    signature = file_signature(path)
+                except FileNotFoundError:
+                    queued.discard(name)
+                    continue
+                # 曾異常結束的檔案不拆分
+                segments = None if crashes.get(name) else split_for_fanout(path, signature[1], memory_budget_mb)
+                try:
+                    if segments is None:
+                        futures = [pool.submit(process_file, path, tests, memory_budget_mb, unit_system, same_day_panels)]
+                    else:
+                        futures = [pool.submit(process_segment, report_prefix(path, seg_idx, len(segments)), segment,
+                                               tests, unit_system, same_day_panels)
+                                   for seg_idx, segment in enumerate(segments)]
+                except BrokenProcessPool:
+                    queue.appendleft(name)
+                    broken = True
+                    break
+                jobs[name] = {"left": len(futures), "results": [None] * len(futures), "crashed": False}
+                for part, future in enumerate(futures):
+                    in_flight[future] = (name, signature, pool, part)
+                if crashes.get(name):
+                    break
+
+            if not in_flight and not broken:
+                if once:
+                    break
+                time.sleep(poll_interval)
+            elif in_flight:
+                done, _ = wait(in_flight, timeout=poll_interval, return_when=FIRST_COMPLETED)
+                recorded = False
+                for future in done:
+                    name, (mtime_ns, size), owner, part = in_flight.pop(future)
+                    job = jobs[name]
+                    try:
+                        job["results"][part] = future.result()
+                    except BrokenProcessPool:
+                        # worker 行程異常結束，整個 pool 都無法再使用
+                        broken = broken or owner is pool
+                        job["crashed"] = True
+                    except Exception as e:
+                        job["results"][part] = ("error", [], 0)
+                        log.error("%s: %s", name, e)
+                    job["left"] -= 1
+                    if job["left"]:
+                        continue
+                    # 這個檔案的所有工作都已結束
+                    del jobs[name]
+                    queued.discard(name)
+                    if job["crashed"]:
+                        # 不寫入 manifest，下次掃描時重試
+                        crashes[name] = crashes.get(name, 0) + 1
+                        if crashes[name] < MAX_CRASH_RETRIES:
+                            log.warning("%s: worker crashed, will retry (%d/%d)", name, crashes[name], MAX_CRASH_RETRIES)
+                            continue
+                        status, reports, peak = "error", [], 0
+                        errors += 1
+                        log.error("%s: worker crashed %d times, giving up", name, crashes[name])
+                    else:
+                        statuses = [result[0] for result in job["results"]]
+                        reports = [report for result in job["results"] for report in result[1]]
+                        peak = max(result[2] for result in job["results"])
+                        if "error" in statuses:
+                            status = "error"
+                            errors += 1
+                        else:
+                            status = statuses[0] if len(statuses) == 1 else ("ok" if reports else "empty")
+                    crashes.pop(name, None)
+                    processed += 1
+                    log.info("%s: %s peak=%.2fMB %s", name, status, peak / 2**20, " ".join(reports))
+                    manifest[name] = {"mtime_ns": mtime_ns, "size": size, "status": status, "reports": reports}
+                    recorded = True
+                if recorded:
+                    write_atomic(manifest_path, json.dumps(manifest, ensure_ascii=False, indent=1))
+            if broken:
+                # 建立新的 pool，舊 pool 中尚未完成的工作已全部失敗，會在下一輪取出
+                log.warning("process pool broken, restarting workers")
+                pool.shutdown(wait=False)
+                pool = ProcessPoolExecutor(max_workers=workers)
+
+            now = time.monotonic()
+            if now - last_metrics >= metrics_interval:
+                last_metrics = now
+                log.info("processed=%d errors=%d throughput=%.2f files/s queue_depth=%d in_flight=%d",
+                         processed, errors, processed / (now - started), len(queue), len(in_flight))
+    finally:
+        pool.shutdown()
+
+    elapsed = time.monotonic() - started
+    log.info("processed=%d errors=%d throughput=%.2f files/s elapsed=%.1fs",
+             processed, errors, processed / elapsed if elapsed else 0.0, elapsed)
+    return processed, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="監看資料夾並自動轉換 LIS 匯出檔")
+    parser.add_argument("watch_dir")
+    parser.add_argument("--pattern", default="*.txt", help="要處理的檔名樣式")
+    parser.add_argument("--tests", nargs="+", choices=TESTS, default=TESTS, help="要產生的報告種類")
+    parser.add_argument("--workers", type=int, default=2, help="同時轉換的行程數")
+    parser.add_argument("--max-queue", type=int, default=32, help="排隊加處理中的檔案上限")
+    parser.add_argument("--poll-interval", type=float, default=2.0, help="掃描間隔（秒）")
+    parser.add_argument("--settle", type=float, default=2.0, help="檔案需多久未變動才處理（秒）")
+    parser.add_argument("--metrics-interval", type=float, default=30.0, help="輸出統計的間隔（秒）")
+    parser.add_argument("--once", action="store_true", help="處理完目前的檔案就結束")
+    parser.add_argument("--memory-budget-mb", type=float, default=er.MEMORY_BUDGET_MB,
+                        help="預估超出此記憶體用量（MB）的檔案改用低記憶體模式，0 表示不限制")
+    parser.add_argument("--unit-system", choices=list(er.UNIT_SYSTEMS), default="conventional",
+                        help="報告使用的單位系統")
+    parser.add_argument("--same-day-panels", action="store_true",
+                        help="另外輸出所有日期的同日檢驗表格（*.labs_report.txt）")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    try:
+        run(args.watch_dir, args.pattern, args.tests, args.workers, args.max_queue, args.poll_interval,
+            args.settle, args.metrics_interval, args.once, args.memory_budget_mb, args.unit_system, args.same_day_panels)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
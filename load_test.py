@@ -0,0 +1,225 @@
+"""本機壓力測試：模擬多位使用者同時轉換，量測四個檢查頁面的吞吐量與延遲
+
+Streamlit 在同一個行程裡以執行緒處理每個 session，因此這裡也用執行緒模擬同時連線的使用者。
+
+用法：
+    python load_test.py --concurrency 1 2 4 8 16 --requests 200
+    python load_test.py --mode app --concurrency 1 2 4 --requests 20
+    python load_test.py --history-days 300 --json bench.json
+    python load_test.py --segments 16 --history-days 300 --parse-workers 1 4 --concurrency 1
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import streamlit.logger
+
+# 直接 import app 時不需要 bare mode 的警告訊息
+streamlit.logger.set_log_level("error")
+
+import Endocrine_report as er
+
+TABS = ["insulin", "clonidine", "gnrh", "glucagon"]
+# 不受目前工作目錄影響
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Endocrine_report.py")
+
+# AppTest 模式下各頁面的輸入框與按鈕 key（Insulin 頁面的輸入框沒有 key）
+APP_WIDGETS = {
+    "insulin": (None, "insulin_btn"),
+    "clonidine": ("clonidine_input", "clonidine_btn"),
+    "gnrh": ("gnrh_input", "gnrh_btn"),
+    "glucagon": ("glucagon_input", "glucagon_btn"),
+}
+
+# 其他常規檢驗，讓合成資料接近實際匯出的大小
+FILLER_CODES = {"72-301": "Na", "72-302": "K", "72-303": "Cl", "72-350": "AST", "72-351": "ALT"}
+
+
+def _session_for(tab, rnd, day):
+    """產生一次動態測試：(日期, 時間列表, {code: 依時間排序的數值})"""
+    def vals(n, low, high):
+        return [f"{rnd.uniform(low, high):.1f}" for _ in range(n)]
+    if tab == "insulin":
+        times = ["0800", "0815", "0830", "0845", "0900", "0930", "1000"]
+        data = {"72-314": vals(7, 40, 120), "72-488": vals(7, 5, 25), "72-476": vals(7, 0.1, 15)}
+    elif tab == "clonidine":
+        times = ["0800", "0830", "0900", "0930", "1000"]
+        data = {"72-476": vals(5, 0.1, 15)}
+    elif tab == "gnrh":
+        times = ["0800", "0830", "0900", "0930", "1000"]
+        data = {"72-482": vals(5, 0.3, 10), "72-483": vals(5, 1, 8)}
+    else:
+        times = ["0800", "0803", "0806", "0810"]
+        data = {"72-314": vals(4, 80, 160), "72-497": vals(4, 0.5, 3)}
+    return day, times, data
+
+
+def make_synthetic_export(tab, history_days=30, seed=0):
+    """產生新版檢驗報告格式的合成資料，包含一次該頁面的動態測試與數天的常規檢驗"""
+    rnd = random.Random(seed)
+    # 動態測試放在最新的日期，各頁面預設顯示最新一次符合條件的測試
+    days = [f"2024{m:02d}{d:02d}" for m in range(12, 0, -1) for d in range(28, 0, -1)]
+    days = days[:max(history_days, 1)]
+    sessions = [_session_for(tab, rnd, days[0])]
+    for day in days[1:]:
+        sessions.append((day, ["0800"], {code: [f"{rnd.uniform(1, 150):.1f}"] for code in FILLER_CODES}))
+    # 欄位由新到舊
+    cols = sorted(((day, t) for day, times, _ in sessions for t in times), reverse=True)
+    col_index = {col: i for i, col in enumerate(cols)}
+    lines = ["選取\t代碼\t名稱\t檢體\t" + cols[0][0]]
+    for i in range(1, len(cols)):
+        lines.append(f"{cols[i-1][1]}\t{cols[i][0]}")
+    lines.append(f"{cols[-1][1]}\t單位\t參考值")
+    values = {}
+    for day, times, data in sessions:
+        for code, series in data.items():
+            row = values.setdefault(code, [""] * len(cols))
+            for t, v in zip(times, series):
+                row[col_index[(day, t)]] = v
+    names = dict(zip(er.PRIMARY_CODES + er.OPTIONAL_CODES, er.PRIMARY_NAMES + er.OPTIONAL_NAMES))
+    names.update(FILLER_CODES)
+    names["72-497"] = "C-peptide"
+    for code, row in values.items():
+        lines.append("\t".join(["True", code, names[code], "B"] + row + ["mg/dL", "0-100"]))
+    return "\n".join(lines)
+
+
+def convert_core(tab, text):
+    """走與頁面相同的流程：判斷格式、分段解析（含記憶體預算與量測），再以預設測試日期產生各份報告"""
+    if er.sniff_lis_text(text) is None:
+        raise ValueError("無法辨識的檢驗資料格式")
+    exports, _, low_memory = er.parse_input(text)
+    results = []
+    for export in exports:
+        if export is None:
+            continue
+        if tab == "insulin":
+            target_date = next(iter(er.find_insulin_sessions(export)), (None,))[0]
+            result = er.maybe_measure_peak_memory(er.render_common_seven_report, export, target_date=target_date,
+                                                  full_matrix=not low_memory)
+        elif tab == "clonidine":
+            target_date = next(iter(er.find_clonidine_sessions(export)), (None,))[0]
+            result = er.maybe_measure_peak_memory(er.render_clonidine_report, export, target_date)
+        elif tab == "gnrh":
+            target_date = next(iter(er.find_gnrh_sessions(export)), (None,))[0]
+            result = er.maybe_measure_peak_memory(er.render_gnrh_report, export, target_date)
+        else:
+            target_date = next(iter(er.find_glucagon_sessions(export)), (None,))[0]
+            result = er.maybe_measure_peak_memory(er.render_glucagon_report, export, target_date)
+        results.append(result)
+    return results
+
+
+def convert_app(tab, text):
+    """以 headless 的 Streamlit AppTest 執行整個頁面腳本"""
+    from streamlit.testing.v1 import AppTest
+    input_key, button_key = APP_WIDGETS[tab]
+    at = AppTest.from_file(APP_PATH, default_timeout=60).run()
+    if input_key is None:
+        at.text_area[0].input(text)
+    else:
+        at.text_area(key=input_key).input(text)
+    at.button(key=button_key).click().run()
+    if at.exception:
+        raise RuntimeError(at.exception[0].value)
+    return at
+
+
+def run_level(convert, payloads, concurrency, requests):
+    """以 concurrency 個執行緒送出 requests 次轉換，回傳延遲（秒）、錯誤數、總時間與第一個錯誤"""
+    def one(i):
+        tab, text = payloads[i % len(payloads)]
+        start = time.perf_counter()
+        try:
+            convert(tab, text)
+            error = None
+        except Exception as e:
+            error = f"{tab}: {type(e).__name__}: {e}"
+        return time.perf_counter() - start, error
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(requests)))
+    wall = time.perf_counter() - start
+    latencies = [lat for lat, error in results if error is None]
+    errors = [error for _, error in results if error is not None]
+    return latencies, len(errors), wall, errors[0] if errors else None
+
+
+def summarize(concurrency, latencies, errors, wall, first_error=None):
+    if len(latencies) >= 2:
+        q = statistics.quantiles(latencies, n=100, method="inclusive")
+        p50, p95, p99 = q[49], q[94], q[98]
+    else:
+        p50 = p95 = p99 = latencies[0] if latencies else float("nan")
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "throughput": len(latencies) / wall if wall else 0.0,
+        "p50_ms": p50 * 1000,
+        "p95_ms": p95 * 1000,
+        "p99_ms": p99 * 1000,
+        "first_error": first_error,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Endocrine report 同時轉換壓力測試")
+    parser.add_argument("--mode", choices=["core", "app"], default="core",
+                        help="core：直接呼叫轉換函式；app：以 AppTest 執行整個 Streamlit 腳本")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--requests", type=int, default=200, help="每個 concurrency 的轉換次數")
+    parser.add_argument("--tabs", nargs="+", choices=TABS, default=TABS)
+    parser.add_argument("--history-days", type=int, default=30, help="合成資料包含的天數")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="另存結果為 JSON，方便比對回歸")
+    parser.add_argument("--measure-memory", action="store_true",
+                        help="與設定 ENDOCRINE_MEASURE_MEMORY=1 相同，轉換時量測記憶體峰值")
+    parser.add_argument("--segments", type=int, default=1,
+                        help="每次貼上的資料包含幾份匯出（多位病人一起貼上）")
+    parser.add_argument("--parse-workers", type=int, nargs="+", default=[er.PARSE_WORKERS],
+                        help="與設定 ENDOCRINE_PARSE_WORKERS 相同，多份資料平行解析的行程數；可列出多個值比較")
+    args = parser.parse_args()
+    if args.measure_memory:
+        # app 模式由 AppTest 重新執行頁面腳本，需透過環境變數開啟
+        os.environ["ENDOCRINE_MEASURE_MEMORY"] = "1"
+        er.MEASURE_MEMORY = True
+
+    payloads = [(tab, "\n".join(make_synthetic_export(tab, args.history_days, seed=args.seed + i * args.segments + k)
+                                for k in range(args.segments)))
+                for i, tab in enumerate(args.tabs)]
+    convert = convert_core if args.mode == "core" else convert_app
+    lines = max(len(er.split_lab_lines(text)) for _, text in payloads)
+
+    print(f"mode={args.mode} tabs={','.join(args.tabs)} history_days={args.history_days} "
+          f"segments={args.segments} lines={lines} measure_memory={er.MEASURE_MEMORY} cpus={os.cpu_count()}")
+    print(f"{'workers':>8}{'clients':>8}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    report = []
+    for workers in args.parse_workers:
+        # app 模式由 AppTest 重新執行頁面腳本，需透過環境變數設定；清除快取讓頁面重新建立行程池
+        os.environ["ENDOCRINE_PARSE_WORKERS"] = str(workers)
+        er.PARSE_WORKERS = workers
+        streamlit.cache_resource.clear()
+        # 暖機，避免第一次 import、啟動解析行程與快取影響結果
+        for tab, text in payloads:
+            convert(tab, text)
+        for concurrency in args.concurrency:
+            row = summarize(concurrency, *run_level(convert, payloads, concurrency, args.requests))
+            row["parse_workers"] = workers
+            report.append(row)
+            print(f"{workers:>8}{row['concurrency']:>8}{row['requests']:>10}{row['errors']:>8}{row['throughput']:>10.1f}"
+                  f"{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}{row['p99_ms']:>10.2f}")
+            if row["errors"]:
+                print(f"    first error: {row['first_error']}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"mode": args.mode, "tabs": args.tabs, "history_days": args.history_days,
+                       "segments": args.segments, "measure_memory": er.MEASURE_MEMORY, "results": report}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()